@@ -1,9 +1,32 @@
 from ctypes import *
+import ctypes.util
 
 as_char_p = lambda a: cast(addressof(a), POINTER(c_ubyte))
 as_void_p = lambda a: cast(addressof(a), c_void_p)
 
-_lib = CDLL('liblzma.so.2')
+# Tried in order before asking the system where liblzma is
+SONAMES = ['liblzma.so.5', 'liblzma.so.2']
+
+_lib = None
+
+# liblzma is only loaded once one of its functions is first used
+def _load():
+    global _lib
+    if _lib is not None:
+        return _lib
+
+    for soname in SONAMES:
+        try:
+            _lib = CDLL(soname)
+            return _lib
+        except OSError:
+            pass
+
+    found = ctypes.util.find_library('lzma')
+    if found is None:
+        raise OSError('liblzma not found')
+    _lib = CDLL(found)
+    return _lib
 
 uint32_t = c_uint if sizeof(c_uint) == 4 else c_ulong
 uint64_t = lzma_vli = c_ulonglong
@@ -81,27 +104,32 @@ class stream(Structure):
                 ) + reserved('szt', c_size_t, 2
                 ) + reserved('enum', c_uint, 2)
 
-lzma_preset = _lib.lzma_lzma_preset
-lzma_preset.restype = lzma_bool
-lzma_preset.argtypes = [POINTER(options_lzma), uint32_t]
-
-raw_encoder = _lib.lzma_raw_encoder
-raw_encoder.restype = ret
-raw_encoder.argtypes = [POINTER(stream), POINTER(filter)]
-
-raw_decoder = _lib.lzma_raw_decoder
-raw_decoder.restype = ret
-raw_decoder.argtypes = [POINTER(stream), POINTER(filter)]
-
-code = _lib.lzma_code
-code.restype = ret
-code.argtypes = [POINTER(stream), action]
-
-end = _lib.lzma_end
-end.restype = None
-end.argtypes = [POINTER(stream)]
+# name: (C symbol, restype, argtypes)
+_FUNCTIONS = {
+    'lzma_preset': ('lzma_lzma_preset', lzma_bool,
+                    [POINTER(options_lzma), uint32_t]),
+    'raw_encoder': ('lzma_raw_encoder', ret,
+                    [POINTER(stream), POINTER(filter)]),
+    'raw_decoder': ('lzma_raw_decoder', ret,
+                    [POINTER(stream), POINTER(filter)]),
+    'code': ('lzma_code', ret, [POINTER(stream), action]),
+    'end': ('lzma_end', None, [POINTER(stream)]),
+    'raw_encoder_memusage': ('lzma_raw_encoder_memusage', uint64_t,
+                             [POINTER(filter)]),
+    'raw_decoder_memusage': ('lzma_raw_decoder_memusage', uint64_t,
+                             [POINTER(filter)]),
+}
+
+def __getattr__(name):
+    if name not in _FUNCTIONS:
+        raise AttributeError('module {!r} has no attribute {!r}'.format(
+            __name__, name))
+
+    symbol, restype, argtypes = _FUNCTIONS[name]
+    func = getattr(_load(), symbol)
+    func.restype = restype
+    func.argtypes = argtypes
+    globals()[name] = func
+    return func
 
-memusage = _lib.lzma_memusage
-memusage.restype = uint64_t
-memusage.argtypes = [POINTER(stream)]
 #raw_buffer_encode = 
@@ -0,0 +1,193 @@
+import os, os.path, stat, tarfile, threading
+from os import O_WRONLY, O_CREAT, O_TRUNC, O_CLOEXEC, O_NOFOLLOW
+from concurrent.futures import ThreadPoolExecutor
+
+__all__ = ['extract_tar']
+
+WRITER_THREADS = 8
+# Members at least this big are streamed to disk by the reading thread
+# instead of being buffered for a writer.
+LARGE_MEMBER = 4 << 20
+# Payload bytes that may be waiting for writers at once
+MAX_PENDING = 64 << 20
+FALLOCATE_SIZE = 1 << 20
+BLOCK_SIZE = 1048576
+
+class _Budget:
+    def __init__(self, limit):
+        self.limit = limit
+        self.used = 0
+        self.cond = threading.Condition()
+
+    def acquire(self, n):
+        with self.cond:
+            while self.used and self.used + n > self.limit:
+                self.cond.wait()
+            self.used += n
+
+    def release(self, n):
+        with self.cond:
+            self.used -= n
+            self.cond.notify_all()
+
+def _preallocate(fd, size):
+    if size >= FALLOCATE_SIZE:
+        try:
+            os.posix_fallocate(fd, 0, size)
+        except OSError: # Not supported by every filesystem
+            pass
+
+def _finish_file(fd, member):
+    os.fchmod(fd, member.mode & 0o7777)
+    os.utime(fd, (member.mtime, member.mtime))
+
+def _write_file(target, data, member):
+    fd = os.open(target,
+                 O_WRONLY | O_CREAT | O_TRUNC | O_CLOEXEC | O_NOFOLLOW, 0o600)
+    try:
+        _preallocate(fd, len(data))
+        view = memoryview(data)
+        while view:
+            view = view[os.write(fd, view):]
+        _finish_file(fd, member)
+    finally:
+        os.close(fd)
+
+def _stream_file(target, src, member):
+    fd = os.open(target,
+                 O_WRONLY | O_CREAT | O_TRUNC | O_CLOEXEC | O_NOFOLLOW, 0o600)
+    try:
+        _preallocate(fd, member.size)
+        block = src.read(BLOCK_SIZE)
+        while block:
+            view = memoryview(block)
+            while view:
+                view = view[os.write(fd, view):]
+            block = src.read(BLOCK_SIZE)
+        _finish_file(fd, member)
+    finally:
+        os.close(fd)
+
+# Whatever is at target goes first, so that nothing is ever written
+# through a symlink, even one that only leads outside in combination with
+# links extracted after it.
+def _clear(target):
+    try:
+        if not stat.S_ISDIR(os.lstat(target).st_mode):
+            os.unlink(target)
+    except FileNotFoundError:
+        pass
+
+def _inside(root, path):
+    return path == root or path.startswith(root + os.sep)
+
+def _target_path(path, name):
+    target = os.path.abspath(os.path.join(path, name))
+    if os.path.isabs(name) or not _inside(os.path.abspath(path), target):
+        raise tarfile.ExtractError('Member escapes destination', name)
+    return target
+
+def extract_tar(fileobj, path='.', threads=WRITER_THREADS):
+    '''\
+Extracts the uncompressed tar stream in fileobj under path.
+
+The stream is decoded on the calling thread while regular files are
+written by a pool of writer threads. Directories are created as they are
+seen and get their final mode and mtime once everything has been
+written; hard links are made last, when their targets exist.
+
+Members whose names or link targets lead outside path, including through
+symlinks extracted earlier, are refused with tarfile.ExtractError. A
+member replaces whatever is at its name rather than writing through it.
+
+Raises tarfile.ReadError if fileobj does not hold a tar archive.
+'''
+    tar = tarfile.open(fileobj=fileobj, mode='r|')
+    budget = _Budget(MAX_PENDING)
+    root = os.path.realpath(path)
+    safe_dirs = set()
+    made_dirs = set()
+    pending = {}
+    directories = []
+    links = []
+    errors = []
+
+    # A symlink extracted earlier may redirect a directory anywhere, so
+    # every directory written into must resolve to somewhere under root.
+    # Resolutions are cached until the next symlink is made.
+    def check_dir(d):
+        if d not in safe_dirs:
+            if not _inside(root, os.path.realpath(d)):
+                raise tarfile.ExtractError('Member escapes destination', d)
+            safe_dirs.add(d)
+
+    def makedirs(d):
+        check_dir(d)
+        if d not in made_dirs:
+            os.makedirs(d, 0o700, exist_ok=True)
+            made_dirs.add(d)
+
+    def done(target, size, future):
+        budget.release(size)
+        if future.exception() is not None:
+            errors.append(future.exception())
+
+    with ThreadPoolExecutor(threads) as pool:
+        for member in tar:
+            if errors:
+                break
+
+            target = _target_path(path, member.name)
+            if target in pending: # Later members replace earlier ones
+                pending.pop(target).result()
+
+            if member.isdir():
+                makedirs(target)
+                directories.append((target, member))
+                continue
+
+            makedirs(os.path.dirname(target))
+            if member.islnk():
+                links.append((target, _target_path(path, member.linkname)))
+            elif member.issym():
+                if os.path.isabs(member.linkname) or not _inside(
+                        root, os.path.realpath(os.path.join(
+                            os.path.dirname(target), member.linkname))):
+                    raise tarfile.ExtractError('Symlink escapes destination',
+                                               member.name)
+                _clear(target)
+                os.symlink(member.linkname, target)
+                safe_dirs.clear()
+            elif not member.isreg():
+                _clear(target)
+                tar.extract(member, path)
+            elif member.size >= LARGE_MEMBER:
+                _clear(target)
+                _stream_file(target, tar.extractfile(member), member)
+            else:
+                _clear(target)
+                data = tar.extractfile(member).read()
+                budget.acquire(len(data))
+                future = pool.submit(_write_file, target, data, member)
+                future.add_done_callback(
+                    lambda f, t=target, n=len(data): done(t, n, f))
+                pending[target] = future
+
+    if errors:
+        raise errors[0]
+
+    for target, source in links:
+        if not _inside(root, os.path.realpath(source)):
+            raise tarfile.ExtractError('Hard link escapes destination',
+                                       source)
+        check_dir(os.path.dirname(target))
+        _clear(target)
+        os.link(source, target)
+
+    # Deepest first, so setting a parent's mtime isn't undone by its children
+    directories.sort(key=lambda d: d[0], reverse=True)
+    for target, member in directories:
+        os.chmod(target, member.mode & 0o7777)
+        os.utime(target, (member.mtime, member.mtime))
+
+    tar.close()
@@ -1,13 +1,79 @@
-import os
+import os, os.path, re, errno, binascii
 from os import O_RDONLY, O_WRONLY, O_CREAT, O_RDWR
 from fcntl import lockf, LOCK_SH, LOCK_EX
 from io import BytesIO
 import tempfile, atexit
 
-__all__ = ['TemporaryFileContext', 'LockFile', 'AtomicReplacement']
+__all__ = ['TemporaryFileContext', 'LockFile', 'AtomicReplacement',
+           'SyncBatch', 'remove_stale_links', 'DURABILITY_NONE',
+           'DURABILITY_DATA', 'DURABILITY_FULL']
 
 BLOCK_SIZE = 1048576
 
+# Leave flushing to the kernel
+DURABILITY_NONE = 0
+# Flush file contents before they replace anything
+DURABILITY_DATA = 1
+# Also flush the directory entries pointing at them
+DURABILITY_FULL = 2
+DEFAULT_DURABILITY = DURABILITY_FULL
+
+# Crash injection: if set, called with the name of each step of a durable
+# write as it completes, so a harness can kill the process right there.
+CRASH_HOOK = None
+
+def _crash_point(name):
+    if CRASH_HOOK is not None:
+        CRASH_HOOK(name)
+
+# Names anonymous files are linked under until renamed over their target
+STALE_LINK_RE = re.compile(r'\.[0-9a-f]{12}\.tmp$')
+
+def remove_stale_links(directory, prefix=''):
+    '''\
+Removes what replacements in directory interrupted between linking and
+renaming left behind, for targets starting with prefix. The caller must
+hold whatever lock keeps others from replacing those targets meanwhile.
+'''
+    for name in os.listdir(directory):
+        if name.startswith(prefix) and STALE_LINK_RE.search(name):
+            try:
+                os.unlink(os.path.join(directory, name))
+            except FileNotFoundError:
+                pass
+
+def fsync_dir(path):
+    fd = os.open(path, O_RDONLY | os.O_DIRECTORY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+class SyncBatch:
+    '''\
+Group commit for directory entries: replacements made with this batch
+only note their directory, and each directory is flushed once when the
+batch is committed on scope exit.
+'''
+    def __init__(self):
+        self.dirs = set()
+
+    def add_dir(self, path):
+        self.dirs.add(os.path.abspath(path))
+
+    def commit(self):
+        for d in sorted(self.dirs):
+            fsync_dir(d)
+        self.dirs.clear()
+        _crash_point('dirs-synced')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, e_t, e_v, tb):
+        if e_t is None:
+            self.commit()
+
 class TemporaryFileContext:
     def __init__(self, suffix='', prefix='tmp', dir=None):
         self.suffix = suffix
@@ -19,6 +85,13 @@ class TemporaryFileContext:
                                            prefix=self.prefix,
                                            dir=self.dir)
 
+    # Stays in memory up to max_size bytes, then rolls over to a file in dir
+    def spool(self, max_size):
+        return tempfile.SpooledTemporaryFile(max_size=max_size,
+                                             suffix=self.suffix,
+                                             prefix=self.prefix,
+                                             dir=self.dir)
+
     def mkdtemp(self):
         return tempfile.TemporaryDirectory(suffix=self.suffix,
                                            prefix=self.prefix,
@@ -26,9 +99,11 @@ class TemporaryFileContext:
 
 # Returns result in BYTES!
 class LockFile:
-    def __init__(self, path, exclusive=False):
+    def __init__(self, path, exclusive=False,
+                 durability=DEFAULT_DURABILITY):
         self.path = path
         self.exclusive = exclusive
+        self.durability = durability
         self.refcount = 0
         self.fd = -1
         self.out_content = None
@@ -76,9 +151,18 @@ class LockFile:
         if self.fd == -1:
             return
 
+        # The file can't be replaced without dropping the lock, so it is
+        # overwritten before being truncated: a crash never leaves an empty
+        # file, but may leave old bytes after the new content, or a mangled
+        # one. Readers must tolerate both.
         if self.out_content is not None:
-            os.ftruncate(self.fd, 0)
-            os.write(self.fd, self.out_content)
+            os.pwrite(self.fd, self.out_content, 0)
+            _crash_point('lock-written')
+            os.ftruncate(self.fd, len(self.out_content))
+            _crash_point('lock-truncated')
+            if self.durability >= DURABILITY_DATA:
+                os.fdatasync(self.fd)
+                _crash_point('lock-synced')
             self.out_content = None
 
         if self.refcount == 0:
@@ -86,32 +170,95 @@ class LockFile:
             self.fd = -1
 
 class AtomicReplacement:
-    def __init__(self, path, tctx):
+    '''\
+Writes a file that replaces path only once ready is set.
+
+Where the filesystem supports O_TMPFILE, the new content lives in an
+anonymous file until it is linked in as <path>.<hex>.tmp right before
+the rename, so only a crash between the two leaves a file behind, for
+remove_stale_links to clear; otherwise a named temporary file from tctx
+is used. With durability set,
+contents are flushed before the rename and the directory after it, or
+when batch is committed if one is given.
+'''
+    def __init__(self, path, tctx, durability=DEFAULT_DURABILITY,
+                 batch=None):
         self.path = path
         self.tempfile_context = tctx
+        self.durability = durability
+        self.batch = batch
         self.ready = False
         self.tempfile = None
+        self.anonymous = False
 
     def __enter__(self):
-        self.tempfile = self.tempfile_context.mkstemp().__enter__()
+        directory = os.path.dirname(os.path.abspath(self.path))
+        try:
+            fd = os.open(directory, os.O_TMPFILE | O_WRONLY, 0o600)
+        except (AttributeError, OSError) as e:
+            if isinstance(e, OSError) and e.errno not in (
+                    errno.EOPNOTSUPP, errno.EISDIR, errno.EINVAL):
+                raise
+            self.tempfile = self.tempfile_context.mkstemp().__enter__()
+        else:
+            self.tempfile = os.fdopen(fd, 'wb')
+            self.anonymous = True
         return self
 
     def write(self, data):
         self.tempfile.write(data)
 
+    def _sync_dir(self):
+        if self.durability < DURABILITY_FULL:
+            return
+        directory = os.path.dirname(os.path.abspath(self.path))
+        if self.batch is not None:
+            self.batch.add_dir(directory)
+        else:
+            fsync_dir(directory)
+
     def __exit__(self, e_t, e_v, tb):
-        if self.ready:
+        if not self.ready:
+            if self.anonymous:
+                self.tempfile.close()
+                return
+            return self.tempfile.__exit__(e_t, e_v, tb)
+
+        self.tempfile.flush()
+        _crash_point('written')
+        if self.durability >= DURABILITY_DATA:
+            os.fdatasync(self.tempfile.fileno())
+            _crash_point('synced')
+
+        if self.anonymous:
+            name = '{}.{}.tmp'.format(self.path,
+                                      binascii.hexlify(os.urandom(6))
+                                      .decode('ascii'))
+            # A directory fd makes os.link use linkat, which is what
+            # follows the /proc magic link to the anonymous file.
+            dir_fd = os.open(os.path.dirname(os.path.abspath(name)),
+                             O_RDONLY | os.O_DIRECTORY)
+            try:
+                os.link('/proc/self/fd/{}'.format(self.tempfile.fileno()),
+                        os.path.basename(name), dst_dir_fd=dir_fd,
+                        follow_symlinks=True)
+            finally:
+                os.close(dir_fd)
+                self.tempfile.close()
+            _crash_point('linked')
+            result = None
+        else:
             self.tempfile.delete = False
             if hasattr(self.tempfile, '_closer'):
                 self.tempfile._closer.delete = False
             name = self.tempfile.name
             result = self.tempfile.__exit__(e_t, e_v, tb)
 
-            try:
-                os.rename(name, self.path)
-            except OSError as e:
-                os.unlink(name)
-                raise
-            return result
-
-        return self.tempfile.__exit__(e_t, e_v, tb)
+        try:
+            os.rename(name, self.path)
+        except OSError as e:
+            os.unlink(name)
+            raise
+        _crash_point('renamed')
+        self._sync_dir()
+        return result
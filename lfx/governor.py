@@ -0,0 +1,141 @@
+import os, sys, time, threading, platform, ctypes
+from concurrent.futures import ThreadPoolExecutor
+
+from .telemetry import cpu_time
+
+__all__ = ['ResourcePolicy', 'Governor']
+
+IOPRIO_CLASS_BE = 2
+IOPRIO_CLASS_IDLE = 3
+IOPRIO_CLASS_SHIFT = 13
+IOPRIO_WHO_PROCESS = 1
+SYS_IOPRIO_SET = {'x86_64': 251, 'aarch64': 30, 'i686': 289, 'i386': 289,
+                  'armv7l': 314, 'ppc64le': 273, 'riscv64': 30}
+
+class ResourcePolicy:
+    '''\
+How background work (snapshot compression, compaction, archive
+recompression) makes way for the browser.
+
+Work runs at nice and the given I/O priority class, and optionally in a
+threaded cgroup v2 with cpu_weight and io_weight. The system is busy when
+the load average per CPU exceeds max_load or the browser uses more than
+max_browser_cpu CPUs; busy work uses busy_preset, and a snapshot may be
+put off up to max_deferrals times in a row.
+'''
+    def __init__(self, nice=10, ioprio_class=IOPRIO_CLASS_IDLE,
+                 ioprio_level=7, cgroup=None, cpu_weight=None,
+                 io_weight=None, max_load=1.0, max_browser_cpu=0.5,
+                 busy_preset=1, max_deferrals=3):
+        self.nice = nice
+        self.ioprio_class = ioprio_class
+        self.ioprio_level = ioprio_level
+        self.cgroup = cgroup
+        self.cpu_weight = cpu_weight
+        self.io_weight = io_weight
+        self.max_load = max_load
+        self.max_browser_cpu = max_browser_cpu
+        self.busy_preset = busy_preset
+        self.max_deferrals = max_deferrals
+
+def _set_ioprio(ioprio_class, level):
+    nr = SYS_IOPRIO_SET.get(platform.machine())
+    if nr is None:
+        return
+    libc = ctypes.CDLL(None, use_errno=True)
+    # who = 0 is the calling thread
+    libc.syscall(nr, IOPRIO_WHO_PROCESS, 0,
+                 (ioprio_class << IOPRIO_CLASS_SHIFT) | level)
+
+class Governor:
+    '''\
+Runs background work on a single worker thread whose CPU and I/O
+priority have been lowered; on Linux both are per thread, so the
+launcher's other threads (and the browser) keep theirs.
+
+When a telemetry sampler watches the browser, its CPU use is taken from
+the sampler and covers the content processes too.
+'''
+    def __init__(self, policy):
+        self.policy = policy
+        self.executor = ThreadPoolExecutor(1, initializer=self._lower)
+        self.deferrals = 0
+        self.last_sample = None
+        self.sampler = None
+
+    def _lower(self):
+        tid = threading.get_native_id()
+        try:
+            os.setpriority(os.PRIO_PROCESS, tid,
+                           max(os.getpriority(os.PRIO_PROCESS, tid),
+                               self.policy.nice))
+            _set_ioprio(self.policy.ioprio_class, self.policy.ioprio_level)
+        except OSError:
+            pass
+
+        if self.policy.cgroup is not None:
+            try:
+                self._join_cgroup(tid)
+            except OSError as e:
+                print('[-] Could not use cgroup {}: {}'.format(
+                    self.policy.cgroup, e), file=sys.stderr)
+
+    def _join_cgroup(self, tid):
+        for name, value in (('cpu.weight', self.policy.cpu_weight),
+                            ('io.weight', self.policy.io_weight)):
+            if value is not None:
+                with open(os.path.join(self.policy.cgroup, name), 'w') as f:
+                    f.write(str(value))
+        with open(os.path.join(self.policy.cgroup, 'cgroup.threads'),
+                  'w') as f:
+            f.write(str(tid))
+
+    def submit(self, fn, *args):
+        return self.executor.submit(fn, *args)
+
+    def run(self, fn, *args):
+        return self.submit(fn, *args).result()
+
+    def shutdown(self):
+        self.executor.shutdown()
+
+    def browser_cpu(self, pid):
+        '''\
+CPUs used by pid since the previous call, or None on the first one.
+'''
+        if self.sampler is not None:
+            return self.sampler.cpu_usage()
+        try:
+            sample = (time.monotonic(), cpu_time(pid))
+        except (OSError, IndexError, ValueError):
+            return None
+        last, self.last_sample = self.last_sample, sample
+        if last is None or sample[0] <= last[0]:
+            return None
+        return (sample[1] - last[1]) / (sample[0] - last[0])
+
+    def busy(self, browser_pid=None):
+        load = os.getloadavg()[0] / (os.cpu_count() or 1)
+        if self.policy.max_load is not None and load > self.policy.max_load:
+            return True
+
+        if browser_pid is not None and self.policy.max_browser_cpu:
+            cpu = self.browser_cpu(browser_pid)
+            if cpu is not None and cpu > self.policy.max_browser_cpu:
+                return True
+        return False
+
+    def should_defer(self, browser_pid):
+        '''\
+Whether to put off a snapshot now; never more than max_deferrals times
+in a row.
+'''
+        if (self.deferrals < self.policy.max_deferrals and
+                self.busy(browser_pid)):
+            self.deferrals += 1
+            return True
+        self.deferrals = 0
+        return False
+
+    def preset(self, default):
+        return self.policy.busy_preset if self.busy() else default
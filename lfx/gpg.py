@@ -1,45 +1,40 @@
-import os
+import os, threading
+
+from .spawn import spawn
 
 __all__ = ['gpg_verify']
 
+def _write_all(fd, data):
+    try:
+        with open(fd, 'wb') as f:
+            f.write(data)
+    except BrokenPipeError: # gpg gave up early; its status says why
+        pass
+
 def gpg_verify(signature, text, keychain):
     rT,wT = os.pipe()
     rS,wS = os.pipe()
 
-    swpid = os.fork()
-    if not swpid:
-        os.close(rT)
-        os.close(wT)
-        os.close(rS)
-        os.write(wS, signature)
-        os._exit(1)
-    os.close(wS)
+    env = os.environ.copy()
+    env['GNUPGHOME'] = keychain
 
-    pid = os.fork()
-    if not pid:
+    try:
+        proc = spawn(['gpg', '--verify', '/proc/self/fd/{}'.format(rS),
+                      '/proc/self/fd/{}'.format(rT)],
+                     env=env, pass_fds=(rS, rT))
+    except BaseException:
+        os.close(wS)
         os.close(wT)
+        raise
+    finally:
+        os.close(rS)
+        os.close(rT)
 
-        if rT == 3:
-            os.dup2(rT,5)
-            os.dup2(3,4)
-            os.dup2(5,3)
-        else:
-            os.dup2(rS,3)
-            os.dup2(rT,4)
-        env = os.environ.copy()
-        env['GNUPGHOME'] = keychain
-
-        os.execvpe('gpg', ['gpg', '--verify', '/proc/self/fd/3',
-                           '/proc/self/fd/4'],
-                   env)
-        os._exit(1)
-
-    os.close(rS)
-    os.close(rT)
-    os.write(wT, text)
-    os.close(wT)
-    
-    _,status = os.waitpid(pid, 0)
-    _ = os.waitpid(swpid, 0)
-    return os.WIFEXITED(status) and not os.WEXITSTATUS(status)
+    # gpg reads all of the signature before the text, so writing the text
+    # first could fill its pipe and deadlock.
+    writer = threading.Thread(target=_write_all, args=(wS, signature))
+    writer.start()
+    _write_all(wT, text)
+    writer.join()
 
+    return proc.wait() == 0
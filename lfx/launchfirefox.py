@@ -1,47 +1,97 @@
 #!/usr/bin/env python3
 
 import os, sys, signal, os.path, tempfile
-import time, shutil, errno, traceback
+import time, shutil, errno, traceback, select
 
 from .lzma import (LZMADecompressor as Decompressor,
                    LZMACompressor as Compressor)
 
-
-from . import updater
-from .filekit import TemporaryFileContext
+from .filekit import TemporaryFileContext, DURABILITY_FULL
+from .extract import extract_tar
+from .spawn import spawn
 from .util import ei, di, display_asterisk
-from .profile import FirefoxProfile
+from .profile import FirefoxProfile, CompactionPolicy
+from .storage import open_store, FORCE_PULL, FORCE_PUSH
+from .governor import Governor, ResourcePolicy
+from .telemetry import ProcessSampler
+from .snapshotrules import SnapshotRules, DEFAULT_RULES
 
 BLOCK_SIZE = 1048576
 MAX_VERSION_LENGTH = 65536
 MAIN_DIRECTORY = os.path.expanduser('~/firefox-launcher')
 
-if not os.path.exists(MAIN_DIRECTORY):
-    os.mkdir(MAIN_DIRECTORY)
-if not os.path.isdir(MAIN_DIRECTORY):
-    print('launchfirefox: {}: not a directory'.format(MAIN_DIRECTORY),
-        file=sys.stderr)
-    exit(1)
-
 FIREFOX_ARCHIVE = os.path.join(MAIN_DIRECTORY, 'firefox-latest.tar.xz')
-# format: version lastdate
+# format: version lastdate [tier]
 VERSION_FILE = os.path.join(MAIN_DIRECTORY, 'firefox-version')
 PROFILE_DIR = os.path.join(MAIN_DIRECTORY, 'profile')
 GNUPG_HOME = os.path.join(MAIN_DIRECTORY, 'gnupg')
 UPDATE_INTERVAL = 86400
 PROFILE_INTERVAL = 120
+# Size above which profile snapshots are spooled to disk
+PROFILE_SPOOL_SIZE = 32 << 20
+COMPACTION_POLICY = CompactionPolicy(max_chain_length=32, size_ratio=1.0,
+                                     idle_time=3600)
+SNAPSHOT_RULES = SnapshotRules(DEFAULT_RULES)
+# Upper bound on the memory used by the profile compressor
+MEMORY_BUDGET = 1 << 30
+# Where profile parts are mirrored to, if anywhere: a directory or an
+# http(s) URL. If both copies changed, the local one is used unsynced
+# until the launcher is started with --force-pull or --force-push.
+REMOTE_STORE = os.environ.get('LFX_REMOTE_STORE')
+# How background compression makes way for the browser, see lfx.governor
+RESOURCE_POLICY = ResourcePolicy(nice=10, max_load=1.0, max_browser_cpu=0.5,
+                                 max_deferrals=3)
+# How hard profile writes try to survive a crash, see lfx.filekit
+DURABILITY = DURABILITY_FULL
+# Seconds between samples of the browser's resource use, None to disable;
+# samples and snapshots (pauses and bytes kept or skipped per rule) are
+# appended to TELEMETRY_FILE as JSON lines
+# and the file is rotated to TELEMETRY_FILE.1 past TELEMETRY_MAX_SIZE
+TELEMETRY_INTERVAL = 1.0
+TELEMETRY_CAPACITY = 3600
+TELEMETRY_FILE = os.path.join(MAIN_DIRECTORY, 'telemetry.jsonl')
+TELEMETRY_MAX_SIZE = 4 << 20
 
 TEMP_CONTEXT = TemporaryFileContext(dir=MAIN_DIRECTORY,
                                     suffix='.~{}~'.format(os.getpid()))
 
+def ensure_main_directory():
+    if not os.path.exists(MAIN_DIRECTORY):
+        os.mkdir(MAIN_DIRECTORY)
+    if not os.path.isdir(MAIN_DIRECTORY):
+        print('launchfirefox: {}: not a directory'.format(MAIN_DIRECTORY),
+            file=sys.stderr)
+        exit(1)
+
 def main():
+    # Only needed once an update check actually runs
+    from . import updater
+
+    ensure_main_directory()
+    args = sys.argv[1:]
+    sync_force = None
+    for flag, mode in (('--force-pull', FORCE_PULL),
+                       ('--force-push', FORCE_PUSH)):
+        if flag in args:
+            args.remove(flag)
+            sync_force = mode
+
+    if args == ['--compact']:
+        compact_profile(PROFILE_DIR, TEMP_CONTEXT, sync_force)
+        return
+    if args == ['--recompress']:
+        updater.recompress_firefox(TEMP_CONTEXT, VERSION_FILE,
+                                   FIREFOX_ARCHIVE)
+        return
+
     di()
     firefox_launcher_pid = os.fork()
     if not firefox_launcher_pid:
         sys.stdout.flush()
         try:
             ei()
-            launch_firefox(PROFILE_DIR, FIREFOX_ARCHIVE, TEMP_CONTEXT)
+            launch_firefox(PROFILE_DIR, FIREFOX_ARCHIVE, TEMP_CONTEXT,
+                           sync_force)
         except KeyboardInterrupt:
             os._exit(2)
         except:
@@ -67,6 +117,19 @@ def main():
         os.kill(firefox_launcher_pid, signal.SIGINT)
         raise
 
+    # The browser is starting from the current archive; use the time to
+    # bring a quickly stored one to full compression, unless the machine
+    # is already busy.
+    governor = Governor(RESOURCE_POLICY)
+    if not updating and not governor.busy():
+        try:
+            governor.run(updater.recompress_firefox, TEMP_CONTEXT,
+                         VERSION_FILE, FIREFOX_ARCHIVE)
+        except Exception:
+            print('[-] Failed to recompress Firefox', file=sys.stderr)
+            traceback.print_exc()
+    governor.shutdown()
+
     while 1:
         try:
             p,q = os.wait()
@@ -82,7 +145,8 @@ def main():
     assert p == firefox_launcher_pid
 
     if updating:
-        launch_firefox(PROFILE_DIR, FIREFOX_ARCHIVE, TEMP_CONTEXT)
+        launch_firefox(PROFILE_DIR, FIREFOX_ARCHIVE, TEMP_CONTEXT,
+                       sync_force)
 
 
 def unpack_firefox(archive):
@@ -92,13 +156,28 @@ def unpack_firefox(archive):
     decompressed = tempfile.NamedTemporaryFile()
     dec.decompress_pump(lambda: arc.read(BLOCK_SIZE), decompressed.write,
                         lambda: 0)
-    decompressed.flush()
+    decompressed.seek(0)
+
+    extract_tar(decompressed)
+
+def remote_store():
+    return open_store(REMOTE_STORE) if REMOTE_STORE else None
 
-    shutil.unpack_archive(decompressed.name, format='tar')
+# Maintenance entry point: compacts the stored profile if the policy asks
+# for it, waiting for any running session to release the profile first.
+def compact_profile(profile_f, temp_ctx, sync_force=None):
+    print('[-] Compacting your Profile... ', end=' ')
+    sys.stdout.flush()
+    with FirefoxProfile(profile_f, temp_ctx, display_asterisk, BLOCK_SIZE,
+                        PROFILE_SPOOL_SIZE, COMPACTION_POLICY, SNAPSHOT_RULES,
+                        MEMORY_BUDGET, DURABILITY, remote_store(),
+                        sync_force=sync_force) as prof:
+        compacted = prof.maintain()
+    print(' Done' if compacted else 'Not needed')
 
 # Should be called with interrupts disabled
 # Launches the browser in archive with the profile profile
-def launch_firefox(profile_f, archive, temp_ctx):
+def launch_firefox(profile_f, archive, temp_ctx, sync_force=None):
     print('[-] Unpacking the Browser... ', end=' ')
     sys.stdout.flush()
     with tempfile.TemporaryDirectory(prefix='firefox-launcher') as direct:
@@ -116,78 +195,135 @@ def launch_firefox(profile_f, archive, temp_ctx):
 
         print('[-] Loading your Profile... ', end=' ')
         sys.stdout.flush()
+        governor = Governor(RESOURCE_POLICY)
         with FirefoxProfile(profile_f, temp_ctx, display_asterisk,
-                            BLOCK_SIZE) as prof:
+                            BLOCK_SIZE, PROFILE_SPOOL_SIZE,
+                            COMPACTION_POLICY, SNAPSHOT_RULES,
+                            MEMORY_BUDGET, DURABILITY,
+                            remote_store(), governor, sync_force) as prof:
             prof.load()
             print(' Done')
+            print_codec_info(prof)
 
             print('[-] Launching')
             sys.stdout.flush()
             start_firefox_in_cwd(prof)
+        governor.shutdown()
+
+def print_codec_info(profile):
+    params = profile.filter_params
+    print('[-] Profile compression: preset {}, {} MiB dictionary, '
+          '{} MiB encoder, {} MiB decoder'.format(
+              params.preset, params.dict_size >> 20,
+              params.encoder_memusage() >> 20,
+              profile.decoder_memusage >> 20))
 
 # Starts Firefox in the current directory and takes care of it
 def start_firefox_in_cwd(profile):
-    pid = os.getpid()
-    child_pid = -1
+    env = os.environ.copy()
+    env['HOME'] = os.getcwd()
 
     di()
+    child = spawn(['./firefox'], env=env, cwd='firefox')
+    sampler = None
+    if TELEMETRY_INTERVAL is not None:
+        sampler = ProcessSampler(child.pid, TELEMETRY_INTERVAL,
+                                 TELEMETRY_CAPACITY).start()
+        if profile.governor is not None:
+            profile.governor.sampler = sampler
+    manager_loop(profile, child, sampler=sampler)
+
+# Sleeps until time t or until child exits, and tells which happened
+def wait_until(t, child):
     try:
-        child_pid = os.fork()
-
-        if not child_pid:
-            env = os.environ
-            env['HOME'] = os.getcwd()
-            os.chdir('firefox')
-            os.execve('./firefox', ['./firefox'], env)
-            os._exit(1)
-    except BaseException:
-        if pid != os.getpid(): # All secondary processes
-            os._exit(1)
-
-        raise
-
-    manager_loop(profile, child_pid)
-
-def wait_until(t):
-    clock_pid = os.fork()
-    if not clock_pid:
-        to_sleep = t - time.time()
-        if to_sleep > 0:
-            time.sleep(to_sleep)
-        os._exit(0)
+        pidfd = os.pidfd_open(child.pid)
+    except (AttributeError, OSError): # Needs Linux 5.3
+        pidfd = None
 
-    p,s = os.wait()
-    return (None if p == clock_pid else p), s
+    try:
+        while child.poll() is None:
+            to_sleep = t - time.time()
+            if to_sleep <= 0:
+                return False
+            if pidfd is None:
+                time.sleep(min(to_sleep, 1))
+            else:
+                select.select([pidfd], [], [], to_sleep)
+        return True
+    finally:
+        if pidfd is not None:
+            os.close(pidfd)
 
-def manager_loop(profile, child_pid, profile_interval=PROFILE_INTERVAL):
-    p = -1
+def export_telemetry(sampler):
+    try:
+        try:
+            if os.path.getsize(TELEMETRY_FILE) >= TELEMETRY_MAX_SIZE:
+                os.replace(TELEMETRY_FILE, TELEMETRY_FILE + '.1')
+        except FileNotFoundError:
+            pass
+        with open(TELEMETRY_FILE, 'a') as f:
+            sampler.export_jsonl(f)
+    except OSError as e:
+        sys.stderr.write('[-] Could not write telemetry: {}\n'.format(e))
+
+def manager_loop(profile, child, profile_interval=PROFILE_INTERVAL,
+                 sampler=None):
+    exited = False
     next_check = time.time() + PROFILE_INTERVAL
     try:
-        while p != child_pid:
-            p, _ = wait_until(next_check)
+        while not exited:
+            exited = wait_until(next_check, child)
             next_check = time.time() + PROFILE_INTERVAL
 
-            snapshot_profile(profile, child_pid if p != child_pid else None)
-        profile.coalesce()
+            if not exited and profile.governor is not None and \
+               profile.governor.should_defer(child.pid):
+                sys.stderr.write('[-] Busy, snapshot put off\n')
+                if sampler is not None:
+                    sampler.mark('snapshot-deferred')
+                continue
+
+            snapshot_profile(profile, child.pid if not exited else None,
+                             sampler)
+            if not exited:
+                profile.compact_if_needed()
+            if sampler is not None:
+                export_telemetry(sampler)
     finally:
-        if p != child_pid:
-            os.kill(child_pid, signal.SIGINT)
-
-def snapshot_profile(profile, child_pid):
+        if not exited:
+            child.send_signal(signal.SIGINT)
+        if sampler is not None:
+            sampler.stop()
+            if profile.governor is not None:
+                profile.governor.sampler = None
+            export_telemetry(sampler)
+
+# Records how long the browser was stopped and the save took with sampler
+def snapshot_profile(profile, child_pid, sampler=None):
     sys.stderr.write('[-] Snapshotting... ')
     sys.stderr.flush()
+    # Don't keep the browser stopped while a compaction finishes
+    profile.join_compaction()
+    started = time.monotonic()
     if child_pid:
         os.kill(child_pid, signal.SIGSTOP)
     profile.snapshot_profile()
     if child_pid:
         os.kill(child_pid, signal.SIGCONT)
-    sys.stderr.write('Done\n')
+    paused = time.monotonic() - started
+    # Sizes excluded directories, so only once the browser runs again
+    sys.stderr.write('Done (skipped {} KiB)\n'.format(
+        profile.last_snapshot.total_skipped() >> 10))
 
     sys.stderr.write('[-] Saving... ')
     sys.stderr.flush()
     profile.write_profile()
     sys.stderr.write(' Done\n')
     sys.stderr.flush()
+    if sampler is not None:
+        sampler.mark('snapshot', paused=paused,
+                     saved=time.monotonic() - started - paused,
+                     skipped=profile.last_snapshot.total_skipped(),
+                     rules=profile.last_snapshot.report())
 
 if __name__ == '__main__':
     main()
@@ -1,5 +1,6 @@
-__all__ = ['FILTER_PREPACK', 'FILTER_DELTA', 'LZMACompressor',
-           'LZMADecompressor']
+__all__ = ['FILTER_PREPACK', 'FILTER_FAST', 'FILTER_DELTA',
+           'LZMACompressor', 'LZMADecompressor', 'FilterParams', 'tune_filter',
+           'read_filter_header']
 
 import ctypes, io, struct
 from ctypes import byref, POINTER
@@ -38,25 +39,150 @@ def _setup_filter(preset, **options):
 
     return POINTER(_lzma.filter)(filters), (opts,filters,)
 
-FILTER_PREPACK = _setup_filter(9)
-FILTER_DELTA = _setup_filter(6, mf=_lzma.MF_HC4, dict_size=512<<20)
-FILTER_DELTA2 = _setup_filter(6, mf=_lzma.MF_HC4, dict_size=128<<20)
+# Filters are set up on first use, as that needs liblzma loaded
+_FILTERS = {
+    'FILTER_PREPACK': (9, {}),
+    # Decodable with FILTER_PREPACK, whose dictionary is larger
+    'FILTER_FAST': (1, {}),
+    'FILTER_DELTA': (6, dict(mf=_lzma.MF_HC4, dict_size=512<<20)),
+    'FILTER_DELTA2': (6, dict(mf=_lzma.MF_HC4, dict_size=128<<20)),
+}
+
+def _filter(name):
+    if name not in globals():
+        preset, options = _FILTERS[name]
+        globals()[name] = _setup_filter(preset, **options)
+    return globals()[name]
+
+def __getattr__(name):
+    if name not in _FILTERS:
+        raise AttributeError('module {!r} has no attribute {!r}'.format(
+            __name__, name))
+    return _filter(name)
+
+# magic, version, preset, match finder, dictionary size
+FILTER_HEADER = struct.Struct('<4sBBBI')
+FILTER_MAGIC = b'LFXZ'
+
+DICT_SIZE_MAX = 1536<<20
+DEFAULT_MEMORY_BUDGET = 1<<30
+# Below this, the extra compression time of binary tree match finding
+# doesn't matter
+SMALL_INPUT = 64<<20
+
+class FilterParams:
+    '''\
+LZMA2 settings that can be stored ahead of a raw stream, so that it is
+decoded with a dictionary matching the one it was encoded with.
+'''
+    def __init__(self, preset, mf, dict_size):
+        self.preset, self.mf, self.dict_size = preset, mf, dict_size
+        self._filter = None
+
+    def filter(self):
+        if self._filter is None:
+            self._filter = _setup_filter(self.preset, mf=self.mf,
+                                         dict_size=self.dict_size)
+        return self._filter
+
+    def encoder_memusage(self):
+        return _lzma.raw_encoder_memusage(self.filter()[0])
+
+    def decoder_memusage(self):
+        return _lzma.raw_decoder_memusage(self.filter()[0])
+
+    def header(self):
+        return FILTER_HEADER.pack(FILTER_MAGIC, 1, self.preset, self.mf,
+                                  self.dict_size)
+
+    def __repr__(self):
+        return 'FilterParams(preset={}, mf={:#x}, dict_size={})'.format(
+            self.preset, self.mf, self.dict_size)
+
+# What FILTER_DELTA2 streams written before headers existed used
+LEGACY_PARAMS = FilterParams(6, _lzma.MF_HC4, 128<<20)
+
+def read_filter_header(f):
+    '''\
+Reads the FilterParams stored at the start of f. Headerless streams are
+left unread and get LEGACY_PARAMS.
+'''
+    data = f.read(FILTER_HEADER.size)
+    if len(data) == FILTER_HEADER.size:
+        magic, version, preset, mf, dict_size = FILTER_HEADER.unpack(data)
+        if magic == FILTER_MAGIC and version == 1:
+            return FilterParams(preset, mf, dict_size)
+    f.seek(-len(data), 1)
+    return LEGACY_PARAMS
+
+def available_memory():
+    try:
+        with open('/proc/meminfo') as meminfo:
+            for line in meminfo:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) << 10
+    except (OSError, ValueError, IndexError):
+        pass
+    return None
+
+def tune_filter(input_size, budget=DEFAULT_MEMORY_BUDGET, preset=6):
+    '''\
+Picks FilterParams for compressing input_size bytes, and then snapshots of
+similar size after them, within budget bytes of encoder memory (and at
+most half of the currently available memory).
+
+The dictionary is made large enough to reach back over a whole snapshot
+where possible, since that is what makes the following parts small.
+'''
+    free = available_memory()
+    if free is not None:
+        budget = min(budget, free // 2)
+
+    # Sizes are tried from the smallest one covering the input downwards,
+    # so a larger input never ends up with a smaller dictionary.
+    sizes = _dict_sizes()
+    wanted = input_size + (input_size >> 2)
+    i = next((i for i, size in enumerate(sizes) if size >= wanted),
+             len(sizes) - 1)
+
+    mf = _lzma.MF_BT4 if input_size < SMALL_INPUT else _lzma.MF_HC4
+    params = FilterParams(preset, mf, sizes[i])
+    while params.encoder_memusage() > budget and i > 0:
+        i -= 1
+        params = FilterParams(preset, mf, sizes[i])
+    return params
+
+# Powers of two from 1 MiB and the sizes halfway between them, ascending
+def _dict_sizes():
+    sizes, size = [], 1<<20
+    while size <= DICT_SIZE_MAX:
+        sizes.append(size)
+        if size + (size >> 1) <= DICT_SIZE_MAX:
+            sizes.append(size + (size >> 1))
+        size <<= 1
+    return sizes
 
 class _LZMACodec:
     # filter[1] is gc keepalive, only filter[0] is  used
-    def __init__(self, *, bufsize=1048576, filter=FILTER_PREPACK):
+    def __init__(self, *, bufsize=1048576, filter=None):
+        if filter is None:
+            filter = _filter('FILTER_PREPACK')
         self.stream = _lzma.stream()
         self.stream.total_out = self.stream.total_in = 0
         self.stream.next_out = self.stream.next_in = None
         self.bufsize = bufsize
         self.eof = False
-        err = self.initfunc(byref(self.stream), filter[0])
+        err = getattr(_lzma, self.initfunc)(byref(self.stream), filter[0])
 
         if err:
             raise ValueError('raw_encoder returned errno', err)
 
-    def code(self, data, action=_lzma.RUN):
+    # Output is handed to write as it is produced when given, so a small
+    # input that expands a lot never has to fit in memory at once.
+    def code(self, data, action=_lzma.RUN, write=None):
         result = io.BytesIO()
+        if write is None:
+            write = result.write
         view = memoryview(data)
         self.stream.next_in = PyMemoryView_GET_BASE(view)
         self.stream.avail_in = len(view)
@@ -73,7 +199,7 @@ class _LZMACodec:
                 self.stream.next_out = self.stream.next_in = None
                 raise ValueError('LZMA returned error code', err)
 
-            result.write(buf[:ptr_diff(self.stream.next_out, buf_addr)])
+            write(bytes(buf[:ptr_diff(self.stream.next_out, buf_addr)]))
 
         self.eof = err
         self.stream.next_out = self.stream.next_in = None
@@ -82,7 +208,7 @@ class _LZMACodec:
     def code_pump(self, read, write, callback, action=_lzma.RUN):
         cur = read()
         while cur:
-            write(self.code(cur, action))
+            self.code(cur, action, write)
             callback()
             cur = read()
 
@@ -91,10 +217,10 @@ class _LZMACodec:
             _lzma.end(byref(self.stream))
 
 class LZMACompressor(_LZMACodec):
-    initfunc = _lzma.raw_encoder
+    initfunc = 'raw_encoder'
 
-    def compress(self, data):
-        return self.code(data)
+    def compress(self, data, write=None):
+        return self.code(data, write=write)
 
     def compress_pump(self, read, write, callback):
         self.code_pump(read, write, callback)
@@ -106,7 +232,7 @@ class LZMACompressor(_LZMACodec):
         return self.code(b'', _lzma.SYNC_FLUSH)
 
 class LZMADecompressor(_LZMACodec):
-    initfunc = _lzma.raw_decoder
+    initfunc = 'raw_decoder'
 
     def decompress(self, data):
         # Fix empty decompress after EOS
@@ -1,12 +1,14 @@
 import re, io, http.client, sys
 
-from .util import SANE_SSL_CONTEXT
+from .util import sane_ssl_context
 from .gpg import gpg_verify
 
 __all__ = ['FirefoxVersion', 'get_latest_firefox_version',
-           'get_firefox_hash', 'get_firefox_bz2', 'VERSION_RE']
+           'get_firefox_hash', 'get_firefox_bz2', 'stream_firefox_bz2',
+           'VERSION_RE', 'HASH_ALGO']
 
 VERSION_RE = '([0-9]+(?:[.][0-9]+)*)'
+HASH_ALGO = 'sha512'
 
 CDN_HOST = 'download-installer.cdn.mozilla.net'
 CDN_DIR = '/pub/firefox/releases/{0}/'
@@ -37,7 +39,7 @@ class FirefoxVersion(str):
 
 def get_latest_firefox_version():
     conn = http.client.HTTPSConnection(VCHECK_HOST,
-                                       context=SANE_SSL_CONTEXT)
+                                       context=sane_ssl_context())
     conn.request('get', VCHECK_PATH)
     resp = conn.getresponse()
 
@@ -60,10 +62,8 @@ def _location_to_firefox_version(location):
 
 BLOCK_SIZE = 1048576
 
-def _get_from_cdn(conn, version, filename, callback=lambda: None,
-                  block_size=BLOCK_SIZE):
-    result = io.BytesIO()
-
+def _stream_from_cdn(conn, version, filename, write, callback=lambda: None,
+                     block_size=BLOCK_SIZE):
     url = CDN_DIR.format(version) + filename
     print('GET %s ' % url,end='', file=sys.stderr)
     conn.request('GET', url)
@@ -74,11 +74,16 @@ def _get_from_cdn(conn, version, filename, callback=lambda: None,
     block = response.read(block_size)
     while block:
         callback()
-        result.write(block)
+        write(block)
         block = response.read(block_size)
 
     print(file=sys.stderr)
-    result.seek(0)
+
+def _get_from_cdn(conn, version, filename, callback=lambda: None,
+                  block_size=BLOCK_SIZE):
+    result = io.BytesIO()
+    _stream_from_cdn(conn, version, filename, result.write, callback,
+                     block_size)
     return result.getvalue()
 
 def get_firefox_hash(version, keychain):
@@ -90,7 +95,7 @@ def get_firefox_hash(version, keychain):
     if not gpg_verify(sha512sums_asc, sha512sums, keychain):
         raise ValueError('Bad SHA512SUMS signature')
 
-    return 'sha512', _extract_hash(sha512sums, version)
+    return HASH_ALGO, _extract_hash(sha512sums, version)
 
 def _get_sha512sums(conn, version):
     return _get_from_cdn(conn, version, 'SHA512SUMS')
@@ -109,3 +114,7 @@ def get_firefox_bz2(version, callback=lambda: None):
     return _get_from_cdn(http.client.HTTPConnection(CDN_HOST),
                          version, CDN_FIREFOX.format(version),
                          callback)
+
+def stream_firefox_bz2(version, write, callback=lambda: None):
+    _stream_from_cdn(http.client.HTTPConnection(CDN_HOST), version,
+                     CDN_FIREFOX.format(version), write, callback)
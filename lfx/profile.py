@@ -1,8 +1,14 @@
-import os, os.path, tarfile, io, re
+import os, os.path, sys, tarfile, re, threading, time
+from concurrent.futures import ThreadPoolExecutor
 
-from .filekit import LockFile, AtomicReplacement
-from .lzma import LZMACompressor, LZMADecompressor, FILTER_DELTA
-from .lzma import FILTER_DELTA2
+from .filekit import LockFile, AtomicReplacement, SyncBatch
+from .filekit import remove_stale_links
+from .filekit import DEFAULT_DURABILITY
+from .extract import extract_tar
+from .snapshotrules import SnapshotRules
+from .storage import ProfileSync, ConflictError, FORCE_PULL, FORCE_PUSH
+from .lzma import LZMACompressor, LZMADecompressor
+from .lzma import tune_filter, read_filter_header, DEFAULT_MEMORY_BUDGET
 
 PARTFILE_RE = re.compile('^profile.([0-9]+).tar.lzD$')
 
@@ -10,9 +16,37 @@ LOCKFILE_NAME = 'profile.lock'
 PARTFILE_NAME = 'profile.{}.tar.lzD'
 COMPLETE_NAME = 'profile.complete.tar.lzD'
 
+# Profile tarballs larger than this are kept on disk instead of in memory
+SPOOL_SIZE = 32 << 20
+
+class CompactionPolicy:
+    '''\
+Decides when a chain of partfiles is worth rewriting into a single base.
+
+A chain is compacted when it has more than max_chain_length parts, when
+the parts appended after the base add up to more than size_ratio times
+the base, or, when checked offline by maintain(), when it has been left
+alone for idle_time seconds.
+'''
+    def __init__(self, max_chain_length=32, size_ratio=1.0, idle_time=3600):
+        self.max_chain_length = max_chain_length
+        self.size_ratio = size_ratio
+        self.idle_time = idle_time
+
+    def should_compact(self, chain_length, base_size, delta_size, idle=0):
+        if chain_length <= 1:
+            return False
+        return (chain_length > self.max_chain_length or
+                delta_size > self.size_ratio * base_size or
+                (self.idle_time is not None and idle >= self.idle_time))
+
 # Assumes firefox is at cwd
 class FirefoxProfile:
-    def __init__(self, profile_dir, temp_ctx, feedback_fun, block_size):
+    def __init__(self, profile_dir, temp_ctx, feedback_fun, block_size,
+                 spool_size=SPOOL_SIZE, policy=None, rules=None,
+                 memory_budget=DEFAULT_MEMORY_BUDGET,
+                 durability=DEFAULT_DURABILITY, storage=None, governor=None,
+                 sync_force=None):
         self.profile_dir = profile_dir
         self.temp_ctx = temp_ctx
         self.compressor = None
@@ -20,7 +54,28 @@ class FirefoxProfile:
         self.next_partfile = 0
         self.block_size = block_size
         self.feedback_fun = feedback_fun
+        self.spool_size = spool_size
         self.last_profile = None
+        self.policy = policy if policy is not None else CompactionPolicy()
+        self.compaction = None
+        self.rules = rules if rules is not None else SnapshotRules()
+        self.last_snapshot = None
+        self.memory_budget = memory_budget
+        self.filter_params = None
+        self.decoder_memusage = 0
+        self.durability = durability
+        self.storage = storage
+        self.sync = None
+        self.sync_force = sync_force
+        self.chain_lock = threading.Lock()
+        self.governor = governor
+        self.executor = (governor.executor if governor is not None
+                         else ThreadPoolExecutor(1))
+
+    def _new_buffer(self):
+        if self.last_profile is not None:
+            self.last_profile.close()
+        return self.temp_ctx.spool(self.spool_size)
 
     def __enter__(self):
         if not os.path.exists(self.profile_dir):
@@ -29,13 +84,89 @@ class FirefoxProfile:
         self.lockfile = LockFile(os.path.join(self.profile_dir,
                                               LOCKFILE_NAME),
                                  exclusive=True).__enter__()
+        remove_stale_links(self.profile_dir)
+        if self.storage is not None:
+            self._start_sync()
         return self
 
+    # A conflict is left for the user to settle with sync_force; until
+    # then the local chain is used as it is and not mirrored.
+    def _start_sync(self):
+        self.sync = ProfileSync(self.storage, self.profile_dir,
+                                PARTFILE_RE, self.chain_lock)
+        try:
+            if self.sync_force == FORCE_PUSH:
+                self.sync.take_over()
+                self._schedule_upload()
+            else:
+                self.sync.pull(force=self.sync_force == FORCE_PULL)
+        except ConflictError as e:
+            print('[-] {}; using the local profile without syncing. Start '
+                  'with --force-pull or --force-push to settle this.'
+                  .format(e), file=sys.stderr)
+            self.sync.close()
+            self.sync = None
+        except Exception as e: # The store is unreachable, most likely
+            print('[-] Could not sync the profile, using the local one: {}'
+                  .format(e), file=sys.stderr)
+            self.sync.close()
+            self.sync = None
+
+    def _schedule_upload(self):
+        if self.sync is not None:
+            self.sync.schedule()
+
     def load(self):
-        self.last_profile = io.BytesIO()
-        self._load_profile(LZMADecompressor(filter=FILTER_DELTA2))
-        self.coalesce()
+        self.last_profile = self._new_buffer()
+        self._load_profile()
         self._extract_profile()
+        # The compressor state can't be recovered from the stored chain, so
+        # a new base is always needed; build it while the browser starts.
+        self.start_compaction()
+
+    # Runs coalesce on the background thread. Everything touching
+    # last_profile or the compressor must call join_compaction first.
+    def start_compaction(self):
+        self.join_compaction()
+        self.filter_params = params = self._tune_filter()
+        self.compaction = self.executor.submit(self.coalesce, lambda: None,
+                                               params)
+
+    def join_compaction(self):
+        if self.compaction is not None:
+            compaction, self.compaction = self.compaction, None
+            compaction.result()
+
+    def chain_stats(self):
+        '''\
+Returns (chain_length, base_size, delta_size, idle) for the stored chain,
+where idle is the number of seconds since its last part was written.
+'''
+        sizes, last_mtime = [], None
+        while os.path.exists(self.partfile_name(len(sizes))):
+            st = os.stat(self.partfile_name(len(sizes)))
+            sizes.append(st.st_size)
+            last_mtime = st.st_mtime
+
+        if not sizes:
+            return 0, 0, 0, 0
+        return (len(sizes), sizes[0], sum(sizes[1:]),
+                time.time() - last_mtime)
+
+    def maintain(self, force=False):
+        '''\
+Offline compaction, for use when no browser is running on the profile.
+Returns True if the chain was rewritten.
+'''
+        chain_length, base, delta, idle = self.chain_stats()
+        if not force and not self.policy.should_compact(chain_length, base,
+                                                        delta, idle):
+            return False
+
+        self.last_profile = self._new_buffer()
+        self._load_profile()
+        self.coalesce()
+        return True
 
     def partfile_name(self, i):
         return os.path.join(self.profile_dir, PARTFILE_NAME.format(i))
@@ -43,65 +174,114 @@ class FirefoxProfile:
     def complete_name(self):
         return os.path.join(self.profile_dir, COMPLETE_NAME)
 
-    def _load_profile(self, dec):
+    # The base of the chain starts with the FilterParams the whole chain
+    # was compressed with.
+    def _load_profile(self):
         if os.path.exists(self.complete_name()):
-            complete_file = open(self.complete_name(), 'rb')
-            dec.decompress_pump(lambda: complete_file.read(self.block_size),
-                                self.last_profile.write, self.feedback_fun)
+            names = [self.complete_name()]
         else:
-            last = 0
-            while os.path.exists(self.partfile_name(last)):
-                self.last_profile.seek(0)
-                self.last_profile.truncate()
-                cur_file = open(self.partfile_name(last), 'rb')
+            names = []
+            while os.path.exists(self.partfile_name(len(names))):
+                names.append(self.partfile_name(len(names)))
+
+        dec = None
+        for name in names:
+            self.last_profile.seek(0)
+            self.last_profile.truncate()
+            with open(name, 'rb') as cur_file:
+                if dec is None:
+                    params = read_filter_header(cur_file)
+                    dec = LZMADecompressor(filter=params.filter())
                 dec.decompress_pump(lambda: cur_file.read(self.block_size),
                                     self.last_profile.write,
                                     self.feedback_fun)
-                last += 1
+        if dec is not None:
+            # lzma_memusage() reports nothing for raw decoders
+            self.decoder_memusage = params.decoder_memusage()
         self.last_profile.seek(0)
 
-    def coalesce(self):
-        self.compressor = LZMACompressor(filter=FILTER_DELTA2)
-        with AtomicReplacement(self.complete_name(), self.temp_ctx) as rep:
-            self.compressor.compress_pump(
-                lambda: self.last_profile.read(self.block_size),
-                rep.write, self.feedback_fun)
-            rep.write(self.compressor.sync())
-            rep.ready = True
+    def _tune_filter(self):
+        size = self.last_profile.seek(0, os.SEEK_END)
+        self.last_profile.seek(0)
+        preset = 6 if self.governor is None else self.governor.preset(6)
+        return tune_filter(size, self.memory_budget, preset)
+
+    def coalesce(self, feedback_fun=None, params=None):
+        if feedback_fun is None:
+            feedback_fun = self.feedback_fun
+        if params is None:
+            params = self._tune_filter()
+
+        self.filter_params = params
+        self.compressor = LZMACompressor(filter=params.filter())
+        # The complete file's contents are flushed before any part goes
+        # away; the directory is flushed once all entries have changed.
+        with SyncBatch() as batch:
+            with AtomicReplacement(self.complete_name(), self.temp_ctx,
+                                   self.durability, batch) as rep:
+                rep.write(params.header())
+                self.compressor.compress_pump(
+                    lambda: self.last_profile.read(self.block_size),
+                    rep.write, feedback_fun)
+                rep.write(self.compressor.sync())
+                rep.ready = True
 
-        for f in os.listdir(self.profile_dir):
-            if PARTFILE_RE.match(f):
-                os.unlink(os.path.join(self.profile_dir, f))
+            with self.chain_lock:
+                for f in os.listdir(self.profile_dir):
+                    if PARTFILE_RE.match(f):
+                        os.unlink(os.path.join(self.profile_dir, f))
 
-        os.rename(self.complete_name(), self.partfile_name(0))
+                os.rename(self.complete_name(), self.partfile_name(0))
         self.next_partfile = 1
         self.last_profile.seek(0)
+        self._schedule_upload()
 
     def _extract_profile(self):
         try:
-            tar = tarfile.open(fileobj=self.last_profile)
-            tar.extractall()
+            extract_tar(self.last_profile)
         except tarfile.ReadError: # tar also crashes on empty file
             pass
         self.last_profile.seek(0)
 
     def __exit__(self, ex, et, tb):
-        return self.lockfile.__exit__(ex, et, tb)
+        try:
+            self.join_compaction()
+            if self.sync is not None:
+                self.sync.close()
+                self.sync = None
+        finally:
+            if self.governor is None:
+                self.executor.shutdown()
+            if self.last_profile is not None:
+                self.last_profile.close()
+                self.last_profile = None
+            self.lockfile.__exit__(ex, et, tb)
 
     def snapshot_profile(self):
-        out = io.BytesIO()
+        self.join_compaction()
+        out = self._new_buffer()
         tar = tarfile.open(fileobj=out, mode='w')
+        walk = self.rules.start()
         if os.path.exists('.fontconfig'):
-            tar.add('.fontconfig')
+            tar.add('.fontconfig', filter=walk.filter)
         if os.path.exists('.mozilla'):
-            tar.add('.mozilla')
+            tar.add('.mozilla', filter=walk.filter)
         tar.close()
+        self.last_snapshot = walk
         out.seek(0)
         self.last_profile = out
 
+    # Only ever appends to the chain; rewriting it into a new base is left
+    # to a background compaction once the policy asks for one.
+    # Compression runs on the background thread, which a governor may have
+    # given lower priority than the rest of the launcher.
     def write_profile(self):
+        self.join_compaction()
+        self.executor.submit(self._write_profile).result()
+
+    def _write_profile(self):
         with AtomicReplacement(self.partfile_name(self.next_partfile),
-                               self.temp_ctx) as rep:
+                               self.temp_ctx, self.durability) as rep:
             self.compressor.compress_pump(
                 lambda: self.last_profile.read(self.block_size),
                 rep.write, self.feedback_fun)
@@ -109,3 +289,14 @@ class FirefoxProfile:
             rep.ready = True
         self.last_profile.seek(0)
         self.next_partfile += 1
+        self._schedule_upload()
+
+    def compact_if_needed(self):
+        '''\
+In-session compaction, checked right after a part was written. The chain
+is never idle then, so only the length and size triggers apply; the
+idle_time trigger is left to maintain().
+'''
+        chain_length, base, delta, _ = self.chain_stats()
+        if self.policy.should_compact(chain_length, base, delta):
+            self.start_compaction()
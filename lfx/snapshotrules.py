@@ -0,0 +1,149 @@
+import os, re
+
+__all__ = ['Rule', 'SnapshotRules', 'DEFAULT_RULES', 'INCLUDE', 'EXCLUDE']
+
+INCLUDE = 'include'
+EXCLUDE = 'exclude'
+
+class Rule:
+    '''\
+A glob pattern over archive paths, matching the path itself and everything
+below it. * and ? match within one path component and ** across any
+number of them. Included subtrees may be capped at max_bytes, after which the
+remaining files under them are left out of the snapshot.
+'''
+    def __init__(self, pattern, action=EXCLUDE, max_bytes=None):
+        if action not in (INCLUDE, EXCLUDE):
+            raise ValueError('Bad rule action', action)
+        self.pattern = pattern
+        self.action = action
+        self.max_bytes = max_bytes
+
+    def __repr__(self):
+        return 'Rule({!r}, {!r}, {!r})'.format(self.pattern, self.action,
+                                              self.max_bytes)
+
+# Data Firefox regenerates on its own
+DEFAULT_RULES = [Rule('.mozilla/firefox/*/' + d) for d in (
+    'cache2', 'startupCache', 'OfflineCache', 'jumpListCache', 'thumbnails',
+    'shader-cache', 'safebrowsing', 'safebrowsing-updating', 'crashes',
+    'minidumps', 'saved-telemetry-pings', 'datareporting/archived',
+    'storage/temporary', 'weave/logs')] + [
+    Rule('.mozilla/firefox/Crash Reports'),
+]
+
+def _translate(pattern):
+    out, i = [], 0
+    while i < len(pattern):
+        c = pattern[i]
+        if pattern.startswith('**/', i): # Also no directory at all
+            out.append('(?:.*/)?')
+            i += 3
+            continue
+        if pattern.startswith('**', i):
+            out.append('.*')
+            i += 2
+            continue
+        if c == '*':
+            out.append('[^/]*')
+        elif c == '?':
+            out.append('[^/]')
+        elif c == '[' and pattern.find(']', i + 2) != -1:
+            end = pattern.find(']', i + 2)
+            chars = pattern[i + 1:end].replace('\\', r'\\')
+            if chars.startswith('!'):
+                chars = '^/' + chars[1:]
+            out.append('[' + chars + ']')
+            i = end + 1
+            continue
+        else:
+            out.append(re.escape(c))
+        i += 1
+    return ''.join(out) + r'(?:/.*)?\Z'
+
+class SnapshotRules:
+    '''\
+A compiled, first-match-wins rule set. Paths matching no rule are
+included.
+'''
+    def __init__(self, rules=DEFAULT_RULES):
+        self.rules = list(rules)
+        self.regex = re.compile('|'.join(
+            '(?P<r{}>{})'.format(i, _translate(rule.pattern))
+            for i, rule in enumerate(self.rules)) or r'(?!)', re.DOTALL)
+
+    def match(self, path):
+        m = self.regex.match(path)
+        return None if m is None else self.rules[int(m.lastgroup[1:])]
+
+    def start(self):
+        return _SnapshotWalk(self)
+
+class _SnapshotWalk:
+    # bytes maps each rule's pattern (None for unmatched paths) to the
+    # number of bytes kept, skipped the same for bytes left out.
+    # The walk runs with the browser stopped, so excluded directories are
+    # only noted there and sized on the first look at skipped.
+    def __init__(self, rules):
+        self.rules = rules
+        self.bytes = {}
+        self._skipped = {}
+        self._pruned = []
+
+    @property
+    def skipped(self):
+        pruned, self._pruned = self._pruned, []
+        for rule, path in pruned:
+            self._count(self._skipped, rule, _tree_size(path))
+        return self._skipped
+
+    def _count(self, counts, rule, size):
+        key = None if rule is None else rule.pattern
+        counts[key] = counts.get(key, 0) + size
+
+    # tarfile.TarFile.add filter; excluding a directory prunes it
+    def filter(self, tarinfo):
+        rule = self.rules.match(tarinfo.name)
+        if rule is not None and rule.action == EXCLUDE:
+            if tarinfo.isdir():
+                self._pruned.append((rule, tarinfo.name))
+            else:
+                self._count(self._skipped, rule, tarinfo.size)
+            return None
+
+        if (rule is not None and rule.max_bytes is not None and
+                self.bytes.get(rule.pattern, 0) + tarinfo.size >
+                rule.max_bytes):
+            self._count(self._skipped, rule, tarinfo.size)
+            return None
+
+        self._count(self.bytes, rule, tarinfo.size)
+        return tarinfo
+
+    def total_skipped(self):
+        return sum(self.skipped.values())
+
+    def report(self):
+        '''\
+Returns {pattern: [bytes kept, bytes skipped]} for every rule that
+matched anything, with paths matching no rule under None.
+'''
+        skipped = self.skipped
+        return {key: [self.bytes.get(key, 0), skipped.get(key, 0)]
+                for key in set(self.bytes) | set(skipped)}
+
+def _tree_size(path):
+    total = 0
+    try:
+        entries = list(os.scandir(path))
+    except OSError:
+        return 0
+    for entry in entries:
+        try:
+            if entry.is_dir(follow_symlinks=False):
+                total += _tree_size(entry.path)
+            else:
+                total += entry.stat(follow_symlinks=False).st_size
+        except OSError:
+            pass
+    return total
@@ -0,0 +1,15 @@
+import subprocess
+
+__all__ = ['spawn']
+
+def spawn(argv, env=None, cwd=None, pass_fds=()):
+    '''\
+Starts argv and returns its subprocess.Popen.
+
+Nothing runs in the child before exec, so subprocess can use vfork() and
+the cost of starting a helper doesn't grow with the launcher's memory.
+Only pass_fds (under their current numbers) and the standard streams are
+inherited; a relative argv[0] is looked up from cwd.
+'''
+    return subprocess.Popen(argv, env=env, cwd=cwd, pass_fds=pass_fds,
+                            close_fds=True)
@@ -0,0 +1,400 @@
+import os, os.path, sys, re, json, hashlib, threading, time, collections
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+
+from .filekit import TemporaryFileContext, AtomicReplacement, LockFile
+from .filekit import fsync_dir
+from .util import sane_ssl_context
+
+__all__ = ['ConflictError', 'DirectoryStore', 'HTTPStore', 'ProfileSync',
+           'open_store', 'FORCE_PULL', 'FORCE_PUSH']
+
+MANIFEST_KEY = 'manifest.json'
+STATE_NAME = 'profile.remote'
+CHUNK_SIZE = 8 << 20
+TRANSFER_THREADS = 4
+# Parts are fetched under this suffix and only renamed once all arrived
+PULL_SUFFIX = '.pull'
+# Chunks dropped from the manifest are kept this many seconds longer for
+# hosts still fetching an older one
+GARBAGE_DELAY = 86400
+
+# Ways out of a ConflictError: replace the local chain with the remote
+# one, or the remote chain with the local one
+FORCE_PULL = 'pull'
+FORCE_PUSH = 'push'
+
+class ConflictError(Exception):
+    '''The remote profile changed since this host last saw it.'''
+
+def open_store(location):
+    if re.match('^https?://', location):
+        return HTTPStore(location)
+    return DirectoryStore(location)
+
+class DirectoryStore:
+    '''\
+Stores objects as files under root, e.g. on a shared mount. The manifest's
+tag is the hash of its content.
+'''
+    def __init__(self, root):
+        self.root = root
+        self.temp_ctx = TemporaryFileContext(dir=root, prefix='.tmp')
+        if not os.path.isdir(root):
+            os.makedirs(root)
+
+    def _path(self, key):
+        return os.path.join(self.root, key)
+
+    def get(self, key):
+        with open(self._path(key), 'rb') as f:
+            return f.read()
+
+    def put(self, key, data):
+        with AtomicReplacement(self._path(key), self.temp_ctx) as rep:
+            rep.write(data)
+            rep.ready = True
+
+    def delete(self, key):
+        try:
+            os.unlink(self._path(key))
+        except FileNotFoundError:
+            pass
+
+    def get_manifest(self):
+        try:
+            data = self.get(MANIFEST_KEY)
+        except FileNotFoundError:
+            return None, None
+        return data, hashlib.sha256(data).hexdigest()
+
+    def put_manifest(self, data, tag):
+        with LockFile(self._path(MANIFEST_KEY + '.lock'), True):
+            if self.get_manifest()[1] != tag:
+                raise ConflictError(tag)
+            self.put(MANIFEST_KEY, data)
+        return hashlib.sha256(data).hexdigest()
+
+class HTTPStore:
+    '''\
+Stores objects under a base URL with plain GET, PUT and DELETE, as object
+stores and WebDAV servers allow. The manifest is replaced with If-Match
+on the ETag it was read with.
+'''
+    def __init__(self, url):
+        parts = urllib.parse.urlsplit(url)
+        self.https = parts.scheme == 'https'
+        self.host = parts.netloc
+        self.prefix = parts.path.rstrip('/') + '/'
+        self.local = threading.local()
+
+    # http.client connections can't be shared between transfer threads
+    def _connection(self):
+        import http.client
+
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            if self.https:
+                conn = http.client.HTTPSConnection(
+                    self.host, context=sane_ssl_context())
+            else:
+                conn = http.client.HTTPConnection(self.host)
+            self.local.conn = conn
+        return conn
+
+    def _request(self, method, key, body=None, headers={}):
+        import http.client
+
+        conn = self._connection()
+        try:
+            conn.request(method, self.prefix + key, body, headers)
+            response = conn.getresponse()
+            return response, response.read()
+        except (http.client.HTTPException, OSError):
+            conn.close()
+            self.local.conn = None
+            raise
+
+    def get(self, key):
+        response, data = self._request('GET', key)
+        if response.status != 200:
+            raise ValueError(response.status, response.reason, key)
+        return data
+
+    def put(self, key, data, headers={}):
+        response, _ = self._request('PUT', key, data, headers)
+        if response.status == 412:
+            raise ConflictError(key)
+        if response.status not in (200, 201, 204):
+            raise ValueError(response.status, response.reason, key)
+        return response
+
+    def delete(self, key):
+        response, _ = self._request('DELETE', key)
+        if response.status not in (200, 202, 204, 404):
+            raise ValueError(response.status, response.reason, key)
+
+    def get_manifest(self):
+        response, data = self._request('GET', MANIFEST_KEY)
+        if response.status == 404:
+            return None, None
+        if response.status != 200:
+            raise ValueError(response.status, response.reason)
+        return data, response.getheader('ETag')
+
+    def put_manifest(self, data, tag):
+        condition = ({'If-None-Match': '*'} if tag is None
+                     else {'If-Match': tag})
+        tag = self.put(MANIFEST_KEY, data, condition).getheader('ETag')
+        return tag if tag is not None else self.get_manifest()[1]
+
+class ProfileSync:
+    '''\
+Mirrors the partfiles of a profile directory to a store.
+
+Parts are split into content-addressed chunks, so a part that was only
+renamed is not sent again. pull() fetches the remote chain in parallel
+before the profile is loaded; schedule() asks a background thread to
+upload whatever changed, and changes made while an upload runs are
+batched into the next one. chain_lock must be held by whoever adds,
+renames or removes parts.
+
+Chunks no longer referenced are listed as garbage in the manifest and
+only deleted by a push GARBAGE_DELAY seconds later.
+
+Upload errors are reported as they happen. A ConflictError stops
+syncing for the rest of the session; anything else is retried with the
+next schedule().
+'''
+    def __init__(self, store, profile_dir, part_re, chain_lock,
+                 chunk_size=CHUNK_SIZE, threads=TRANSFER_THREADS):
+        self.store = store
+        self.profile_dir = profile_dir
+        self.part_re = part_re
+        self.chain_lock = chain_lock
+        self.chunk_size = chunk_size
+        self.threads = threads
+        self.pool = ThreadPoolExecutor(threads)
+        self.temp_ctx = TemporaryFileContext(dir=profile_dir)
+        self.state = self._read_state()
+        self.wanted = threading.Event()
+        self.stopping = False
+        self.error = None
+        self.disabled = False
+        self.thread = None
+        self.thread_lock = threading.Lock()
+
+    def _state_name(self):
+        return os.path.join(self.profile_dir, STATE_NAME)
+
+    def _read_state(self):
+        try:
+            with open(self._state_name()) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {'tag': None, 'parts': {}, 'garbage': {}}
+
+    def _write_state(self):
+        with AtomicReplacement(self._state_name(), self.temp_ctx) as rep:
+            rep.write(json.dumps(self.state).encode('utf-8'))
+            rep.ready = True
+
+    def _local_parts(self):
+        parts = {}
+        for name in os.listdir(self.profile_dir):
+            if self.part_re.match(name):
+                st = os.stat(os.path.join(self.profile_dir, name))
+                parts[name] = [st.st_size, st.st_mtime_ns]
+        return parts
+
+    def _unsynced(self):
+        synced = {name: part['stat']
+                  for name, part in self.state['parts'].items()}
+        return self._local_parts() != synced
+
+    # Only a few chunks are in flight or waiting to be written at any time
+    def _fetch(self, keys):
+        futures = collections.deque()
+        for key in keys:
+            if len(futures) >= 2 * self.threads:
+                yield futures.popleft().result()
+            futures.append(self.pool.submit(self.store.get, key))
+        while futures:
+            yield futures.popleft().result()
+
+    def _staged_name(self, name):
+        return os.path.join(self.profile_dir, name + PULL_SUFFIX)
+
+    def pull(self, force=False):
+        '''\
+Replaces the local chain with the remote one if that changed. Raises
+ConflictError if the local chain changed too, unless force is set.
+'''
+        for name in os.listdir(self.profile_dir):
+            if name.endswith(PULL_SUFFIX): # From an interrupted pull
+                os.unlink(os.path.join(self.profile_dir, name))
+
+        data, tag = self.store.get_manifest()
+        if data is None or tag == self.state['tag']:
+            return
+        if not force and self._unsynced() and self._local_parts():
+            raise ConflictError('Local and remote profiles both changed')
+
+        # Everything is fetched before the first part is replaced, so a
+        # failed pull leaves the local chain as it was.
+        manifest = json.loads(data.decode('utf-8'))
+        chunks = self._fetch(key for part in manifest['parts'].values()
+                             for key in part['chunks'])
+        for name, part in manifest['parts'].items():
+            with AtomicReplacement(self._staged_name(name),
+                                   self.temp_ctx) as rep:
+                for _ in part['chunks']:
+                    rep.write(next(chunks))
+                rep.ready = True
+
+        with self.chain_lock:
+            for name in self._local_parts():
+                if name not in manifest['parts']:
+                    os.unlink(os.path.join(self.profile_dir, name))
+            for name in manifest['parts']:
+                os.rename(self._staged_name(name),
+                          os.path.join(self.profile_dir, name))
+            fsync_dir(self.profile_dir)
+
+            local = self._local_parts()
+            self.state = {'tag': tag, 'parts': {
+                name: {'chunks': part['chunks'], 'stat': local[name]}
+                for name, part in manifest['parts'].items()},
+                'garbage': manifest.get('garbage', {})}
+            self._write_state()
+
+    def take_over(self):
+        '''\
+Makes the next push replace whatever the remote chain holds with the
+local one, however either changed.
+'''
+        data, tag = self.store.get_manifest()
+        manifest = ({'parts': {}} if data is None
+                    else json.loads(data.decode('utf-8')))
+        # No part is recorded as synced, so all of them are uploaded
+        self.state = {'tag': tag, 'parts': {
+            name: {'chunks': part['chunks'], 'stat': None}
+            for name, part in manifest['parts'].items()},
+            'garbage': manifest.get('garbage', {})}
+        self._write_state()
+
+    def schedule(self):
+        with self.thread_lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run,
+                                               daemon=True)
+                self.thread.start()
+        self.wanted.set()
+
+    def _run(self):
+        while True:
+            self.wanted.wait()
+            self.wanted.clear()
+            if not self.disabled:
+                try:
+                    self.push()
+                    self.error = None
+                except ConflictError as e:
+                    print('[-] {}; no longer syncing the profile. Start '
+                          'with --force-pull or --force-push to settle '
+                          'this.'.format(e), file=sys.stderr)
+                    self.error = e
+                    self.disabled = True
+                except Exception as e:
+                    # Likely transient; the next schedule() tries again
+                    print('[-] Profile upload failed, will retry: {}'
+                          .format(e), file=sys.stderr)
+                    self.error = e
+            if self.stopping:
+                return
+
+    # Chunks already in the store are skipped, and only a few are kept in
+    # memory waiting for a transfer thread at any time.
+    def _upload_part(self, f, known, futures):
+        keys = []
+        block = f.read(self.chunk_size)
+        while block:
+            key = hashlib.sha256(block).hexdigest()
+            keys.append(key)
+            if key not in known:
+                known.add(key)
+                if len(futures) >= 2 * self.threads:
+                    futures.pop(0).result()
+                futures.append(self.pool.submit(self.store.put, key, block))
+            block = f.read(self.chunk_size)
+        return keys
+
+    def push(self):
+        # Opening every part under the lock pins a consistent chain; the
+        # data is read from the open files after it is released.
+        with self.chain_lock:
+            local = self._local_parts()
+            files = {name: open(os.path.join(self.profile_dir, name), 'rb')
+                     for name in local
+                     if self.state['parts'].get(name, {}).get('stat') !=
+                        local[name]}
+        if not files and local.keys() == self.state['parts'].keys():
+            return
+
+        old_keys = {key for part in self.state['parts'].values()
+                    for key in part['chunks']}
+        # Garbage is still in the store until collected
+        garbage = dict(self.state.get('garbage', {}))
+        parts, futures, known = {}, [], old_keys | set(garbage)
+        try:
+            for name, stat in local.items():
+                if name in files:
+                    chunks = self._upload_part(files[name], known, futures)
+                else:
+                    chunks = self.state['parts'][name]['chunks']
+                parts[name] = {'chunks': chunks, 'stat': stat}
+        finally:
+            for f in files.values():
+                f.close()
+
+        for future in futures:
+            future.result()
+
+        new_keys = {key for part in parts.values() for key in part['chunks']}
+        now = time.time()
+        for key in old_keys - new_keys:
+            garbage.setdefault(key, now)
+        for key in new_keys:
+            garbage.pop(key, None)
+        expired = [key for key, since in garbage.items()
+                   if now - since >= GARBAGE_DELAY]
+        for key in expired:
+            del garbage[key]
+
+        manifest = {'parts': {name: {'chunks': part['chunks']}
+                              for name, part in parts.items()},
+                    'garbage': garbage}
+        try:
+            tag = self.store.put_manifest(
+                json.dumps(manifest).encode('utf-8'), self.state['tag'])
+        except ConflictError:
+            raise ConflictError('The remote profile changed since it was '
+                                'last synced') from None
+
+        self.state = {'tag': tag, 'parts': parts, 'garbage': garbage}
+        self._write_state()
+
+        for key in expired:
+            self.store.delete(key)
+
+    def close(self):
+        '''\
+Waits for outstanding uploads. Upload errors have been reported as they
+happened; the last one, if the final upload failed too, is left in error.
+'''
+        if self.thread is not None:
+            self.stopping = True
+            self.wanted.set()
+            self.thread.join()
+            self.thread = None
+        self.pool.shutdown()
@@ -0,0 +1,187 @@
+import os, time, json, threading, collections, heapq
+
+__all__ = ['Sample', 'ProcessSampler', 'cpu_time']
+
+# Totals over the browser and all its descendants; cpu_time is in seconds
+Sample = collections.namedtuple('Sample', ['time', 'processes', 'rss',
+                                           'cpu_time', 'read_bytes',
+                                           'write_bytes', 'threads'])
+
+PAGE_SIZE = os.sysconf('SC_PAGE_SIZE')
+CLK_TCK = os.sysconf('SC_CLK_TCK')
+
+# Indices into _read_stat() fields, which start after the command name;
+# see proc(5)
+STAT_PPID = 1
+STAT_UTIME = 11
+STAT_STIME = 12
+STAT_NUM_THREADS = 17
+STAT_RSS = 21
+
+def _read_stat(pid):
+    with open('/proc/{}/stat'.format(pid)) as f:
+        # The command name is parenthesised and may contain anything
+        return f.read().rsplit(')', 1)[1].split()
+
+def _cpu_ticks(fields):
+    return int(fields[STAT_UTIME]) + int(fields[STAT_STIME])
+
+def cpu_time(pid):
+    '''\
+Seconds of CPU pid has used, not counting its children.
+'''
+    return _cpu_ticks(_read_stat(pid)) / CLK_TCK
+
+def _read_io(pid):
+    result = {}
+    try:
+        with open('/proc/{}/io'.format(pid)) as f:
+            for line in f:
+                key, value = line.split(':')
+                result[key] = int(value)
+    except (OSError, ValueError):
+        pass
+    return result
+
+# Needs CONFIG_PROC_CHILDREN; checked on first use
+_have_children = None
+
+def _children(pid):
+    result = []
+    for tid in os.listdir('/proc/{}/task'.format(pid)):
+        try:
+            with open('/proc/{}/task/{}/children'.format(pid, tid)) as f:
+                result.extend(int(child) for child in f.read().split())
+        except FileNotFoundError: # Thread exited meanwhile
+            pass
+    return result
+
+def _process_tree(root):
+    '''\
+Returns {pid: stat fields} for root and its descendants, only visiting
+the tree itself where the kernel lists each thread's children.
+'''
+    global _have_children
+    if _have_children is None:
+        _have_children = os.path.exists('/proc/self/task/{}/children'
+                                        .format(threading.get_native_id()))
+    if not _have_children:
+        return _scan_tree(root)
+
+    tree, todo = {}, [root]
+    while todo:
+        pid = todo.pop()
+        try:
+            tree[pid] = _read_stat(pid)
+            todo.extend(_children(pid))
+        except OSError: # Exited meanwhile
+            pass
+    return tree
+
+# Finds descendants through the parent of every process on the system
+def _scan_tree(root):
+    stats, children = {}, collections.defaultdict(list)
+    for name in os.listdir('/proc'):
+        if not name.isdigit():
+            continue
+        try:
+            fields = _read_stat(name)
+        except OSError: # Exited meanwhile
+            continue
+        pid = int(name)
+        stats[pid] = fields
+        children[int(fields[STAT_PPID])].append(pid)
+
+    tree, todo = {}, [root]
+    while todo:
+        pid = todo.pop()
+        if pid in stats:
+            tree[pid] = stats[pid]
+            todo.extend(children[pid])
+    return tree
+
+class ProcessSampler:
+    '''\
+Samples the resource use of a process tree from /proc every interval
+seconds on a background thread, keeping the last capacity samples and
+events in ring buffers.
+
+Events are marked by the launcher (e.g. snapshot pauses) so they can be
+lined up with the samples once exported as JSON lines.
+'''
+    def __init__(self, pid, interval=1.0, capacity=3600):
+        self.pid = pid
+        self.interval = interval
+        self.samples = collections.deque(maxlen=capacity)
+        self.events = collections.deque(maxlen=capacity)
+        self.exported = 0
+        self.stopping = threading.Event()
+        self.thread = None
+
+    def sample(self):
+        tree = _process_tree(self.pid)
+        rss = cpu = threads = read_bytes = write_bytes = 0
+        for pid, fields in tree.items():
+            cpu += _cpu_ticks(fields)
+            threads += int(fields[STAT_NUM_THREADS])
+            rss += int(fields[STAT_RSS]) * PAGE_SIZE
+            io = _read_io(pid)
+            read_bytes += io.get('read_bytes', 0)
+            write_bytes += io.get('write_bytes', 0)
+
+        sample = Sample(time.time(), len(tree), rss, cpu / CLK_TCK,
+                        read_bytes, write_bytes, threads)
+        self.samples.append(sample)
+        return sample
+
+    def mark(self, event, **info):
+        info.update(time=time.time(), event=event)
+        self.events.append(info)
+
+    def _run(self):
+        while not self.stopping.wait(self.interval):
+            self.sample()
+
+    def start(self):
+        self.sample()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        if self.thread is not None:
+            self.stopping.set()
+            self.thread.join()
+            self.thread = None
+
+    def cpu_usage(self, window=10.0):
+        '''\
+CPUs used by the tree over the last window seconds, or None without two
+samples to compare. Processes exiting in between make this an estimate.
+'''
+        samples = list(self.samples)
+        if len(samples) < 2:
+            return None
+        last = samples[-1]
+        first = next((s for s in samples if s.time >= last.time - window),
+                     samples[0])
+        if first is last:
+            first = samples[-2]
+        return max(last.cpu_time - first.cpu_time, 0) / (last.time -
+                                                         first.time)
+
+    def export_jsonl(self, f):
+        '''\
+Writes the samples and events recorded since the previous export to f as
+JSON lines, in time order.
+'''
+        records = heapq.merge(
+            (dict(s._asdict(), type='sample') for s in list(self.samples)),
+            (dict(e, type='event') for e in list(self.events)),
+            key=lambda r: r['time'])
+        last = self.exported
+        for record in records:
+            if record['time'] > self.exported:
+                f.write(json.dumps(record) + '\n')
+                last = max(last, record['time'])
+        self.exported = last
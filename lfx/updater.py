@@ -1,22 +1,34 @@
-import sys, hashlib, io
+import os, sys, hashlib, io
 from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
 
 from bz2 import BZ2Decompressor
 
 
 from .lzma import (LZMADecompressor as Decompressor,
                    LZMACompressor as Compressor)
+from . import lzma
 
 from . import mozilla
 from .versionfile import VersionFile
-from .filekit import AtomicReplacement
+from .filekit import AtomicReplacement, remove_stale_links
 from .util import display_asterisk
 
+# The archive is first stored quickly, and recompressed when there is time
+TIER_FAST = 'fast'
+TIER_MAX = 'max'
+
+# Archives are only replaced with the version file locked
+def _remove_stale_archives(arc_name):
+    remove_stale_links(os.path.dirname(os.path.abspath(arc_name)),
+                       os.path.basename(arc_name) + '.')
+
 @contextmanager
 def try_update_firefox(temp_ctx, lock_name, arc_name, check_interval,
                        gnupg_dir):
     with VersionFile(lock_name, mozilla.FirefoxVersion,
                      check_interval) as vers:
+        _remove_stale_archives(arc_name)
         time_to_next = vers.can_skip_updates()
         if time_to_next:
             yield (False, time_to_next)
@@ -32,36 +44,86 @@ def try_update_firefox(temp_ctx, lock_name, arc_name, check_interval,
                 print('[+] Updating Firefox', file=sys.stderr)
                 update_firefox(latest, out, gnupg_dir)
                 out.ready = True
+            vers.set_tier(TIER_FAST)
         else:
             yield (False, 1)
 
+# The tarball is converted while it downloads, and the signed hash is
+# fetched and checked alongside. Nothing is committed unless both pass,
+# since the caller only marks out ready once this returns.
 def update_firefox(version, out, gnupg_dir):
-    bz2_archive = get_bz2_archive(version, gnupg_dir)
-    print('[-] Converting & Storing...', end=' ', file=sys.stderr)
-    write_fx_archive(bz2_archive, out)
-    print(' Done', file=sys.stderr)
-
-def get_bz2_archive(version, gnupg_dir):
-    algo, digest = mozilla.get_firefox_hash(version, gnupg_dir)
-    scanner = hashlib.new(algo)
-
-    firefox_bz2 = mozilla.get_firefox_bz2(version, display_asterisk)
-    scanner.update(firefox_bz2)
-    if scanner.hexdigest() != digest:
+    with ThreadPoolExecutor(1) as pool:
+        hash_future = pool.submit(mozilla.get_firefox_hash, version,
+                                  gnupg_dir)
+        scanner = hashlib.new(mozilla.HASH_ALGO)
+        writer = _ArchiveWriter(out, lzma.FILTER_FAST)
+
+        def feed(block):
+            if hash_future.done() and hash_future.exception() is not None:
+                raise hash_future.exception()
+            scanner.update(block)
+            writer.write(block)
+
+        mozilla.stream_firefox_bz2(version, feed, display_asterisk)
+        print('[-] Converting & Storing...', end=' ', file=sys.stderr)
+        writer.finish()
+        print(' Done', file=sys.stderr)
+
+        algo, digest = hash_future.result()
+
+    if algo != mozilla.HASH_ALGO or scanner.hexdigest() != digest:
         raise ValueError('Hash Verification Failure', scanner.hexdigest(),
                          digest)
 
-    return firefox_bz2
+class _ArchiveWriter:
+    def __init__(self, out, filter):
+        self.out = out
+        self.decom = BZ2Decompressor()
+        self.comp = Compressor(filter=filter)
 
-BLOCK_SIZE = 1048576
-def write_fx_archive(firefox_bz2, out):
-    decom = BZ2Decompressor()
-    comp = Compressor()
+    def write(self, block):
+        # BZip2 crashes when decompressing empty string after EOS
+        data = self.decom.decompress(block) if block else b''
+        # and LZMA fails when making no progress
+        if data:
+            self.comp.compress(data, self.out.write)
+
+    def finish(self):
+        self.out.write(self.comp.flush())
 
+BLOCK_SIZE = 1048576
+def write_fx_archive(firefox_bz2, out, filter=None):
+    writer = _ArchiveWriter(out, filter if filter is not None
+                                 else lzma.FILTER_FAST)
     firefox_bz2_f = io.BytesIO(firefox_bz2)
-    def decompress():
-        decompressed = firefox_bz2_f.read(BLOCK_SIZE)
-        # BZip2 crashes when decompressing empty string after EOS
-        return decom.decompress(decompressed) if decompressed else ''
-    comp.compress_pump(decompress, out.write, display_asterisk)
-    out.write(comp.flush())
+    block = firefox_bz2_f.read(BLOCK_SIZE)
+    while block:
+        writer.write(block)
+        display_asterisk()
+        block = firefox_bz2_f.read(BLOCK_SIZE)
+    writer.finish()
+
+def recompress_firefox(temp_ctx, lock_name, arc_name):
+    '''\
+Recompresses an archive stored by a fast update with the maximum preset
+and swaps it in. Returns True if there was anything to do.
+'''
+    with VersionFile(lock_name, mozilla.FirefoxVersion, 0) as vers:
+        _remove_stale_archives(arc_name)
+        if vers.tier != TIER_FAST:
+            return False
+
+        print('[-] Recompressing Firefox...', end=' ', file=sys.stderr)
+        with AtomicReplacement(arc_name, temp_ctx) as out, \
+             open(arc_name, 'rb') as arc:
+            decom = Decompressor()
+            comp = Compressor(filter=lzma.FILTER_PREPACK)
+            def decompress():
+                compressed = arc.read(BLOCK_SIZE)
+                return decom.decompress(compressed) if compressed else b''
+            comp.compress_pump(decompress, out.write, display_asterisk)
+            out.write(comp.flush())
+            out.ready = True
+        vers.set_tier(TIER_MAX)
+        print(' Done', file=sys.stderr)
+        return True
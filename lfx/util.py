@@ -1,10 +1,25 @@
-import ssl, signal, sys
+import signal, sys
 
-__all__ = ['SANE_SSL_CONTEXT', 'di', 'ei']
+__all__ = ['SANE_SSL_CONTEXT', 'sane_ssl_context', 'di', 'ei']
 
-SANE_SSL_CONTEXT = ssl.SSLContext(ssl.PROTOCOL_TLSv1)
-SANE_SSL_CONTEXT.verify_mode = ssl.CERT_REQUIRED
-SANE_SSL_CONTEXT.set_default_verify_paths()
+_ssl_context = None
+
+# Built when the first connection needs it; loading the CA store is slow
+def sane_ssl_context():
+    global _ssl_context
+    if _ssl_context is None:
+        import ssl
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+        context.verify_mode = ssl.CERT_REQUIRED
+        context.set_default_verify_paths()
+        _ssl_context = context
+    return _ssl_context
+
+def __getattr__(name):
+    if name == 'SANE_SSL_CONTEXT':
+        return sane_ssl_context()
+    raise AttributeError('module {!r} has no attribute {!r}'.format(
+        __name__, name))
 
 _have_sigint = False
 _old_sigint_handler = None
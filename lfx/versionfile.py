@@ -2,23 +2,55 @@
 from .filekit import LockFile
 import time
 
+def _is_time(s):
+      try:
+            float(s)
+      except ValueError:
+            return False
+      return True
+
 class VersionFile:
       def __init__(self, fn, version_parser, check_interval):
             self.fn, self.check_interval = fn, check_interval
             self.version_parser = version_parser
             self.version = self.check_time = None
             self.lockf = None
+            self.stored = None
+            self.tier = None
+            self.tier_changed = False
 
+      # format: version lastdate [tier]
+      # Only the first line counts, since a crash while the file is
+      # rewritten may leave old bytes after it; a file that still doesn't
+      # parse is treated as missing.
       def __enter__(self):
             self.lockf = LockFile(self.fn, True).__enter__()
+            line = self.lockf.read().decode('utf-8', 'replace')
+            fields = line.split('\n', 1)[0].strip().split(' ')
+            if len(fields) in (2, 3) and _is_time(fields[1]):
+                  self.stored = fields
+                  self.tier = fields[2] if len(fields) == 3 else None
             return self
 
       def __exit__(self, et, ex, tb):
-            if self.check_time is not None and ex is None:
-                  self.lockf.setvalue('{} {}\n'.format(self.version,
-                                      self.check_time).encode('utf-8'))
+            if ex is None and (self.check_time is not None or
+                               self.tier_changed and self.stored):
+                  version, check_time = self.version, self.check_time
+                  if check_time is None: # Only the tier changed
+                        version, check_time = self.stored[:2]
+                  value = '{} {}'.format(version, check_time)
+                  if self.tier is not None:
+                        value += ' ' + self.tier
+                  self.lockf.setvalue((value + '\n').encode('utf-8'))
             return self.lockf.__exit__(et, ex, tb)
 
+      def set_tier(self, tier):
+            '''\
+Records how the stored archive is compressed; saved on scope exit.
+'''
+            self.tier = tier
+            self.tier_changed = True
+
       def can_skip_updates(self):
             '''\
 Returns falsey if updates can be skipped, or number of seconds before
@@ -26,11 +58,10 @@ Returns falsey if updates can be skipped, or number of seconds before
 
 Must be called before receive_update.
 '''
-            version_d = self.lockf.read().decode('utf-8').strip().split(' ')
-            if len(version_d) != 2:
+            if self.stored is None:
                   self.check_time = time.time()
                   return 0
-            version_s, time_s = version_d            
+            version_s, time_s = self.stored[:2]
 
             cur_time = time.time()
             if cur_time - float(time_s) < self.check_interval:
@@ -0,0 +1,125 @@
+import io, os, stat, tarfile, tempfile, unittest
+
+from lfx.extract import extract_tar, LARGE_MEMBER
+
+def _add(tar, name, type=tarfile.REGTYPE, data=b'', mode=0o644, **kw):
+    info = tarfile.TarInfo(name)
+    info.type = type
+    info.mode = mode
+    info.mtime = 1500000000
+    info.size = len(data)
+    for key, value in kw.items():
+        setattr(info, key, value)
+    tar.addfile(info, io.BytesIO(data) if data else None)
+
+def _archive(build):
+    buf = io.BytesIO()
+    with tarfile.open(fileobj=buf, mode='w') as tar:
+        build(tar)
+    buf.seek(0)
+    return buf
+
+def _sample(tar):
+    _add(tar, 'd', tarfile.DIRTYPE, mode=0o750)
+    _add(tar, 'd/small', data=b'hello', mode=0o600)
+    _add(tar, 'd/exec', data=b'#!/bin/sh\n', mode=0o755)
+    _add(tar, 'd/large', data=os.urandom(LARGE_MEMBER + 12345))
+    _add(tar, 'd/empty')
+    _add(tar, 'd/sub/deep/file', data=b'implicit parents')
+    _add(tar, 'd/hard', tarfile.LNKTYPE, linkname='d/small')
+    _add(tar, 'd/sym', tarfile.SYMTYPE, linkname='small')
+    _add(tar, 'd/fifo', tarfile.FIFOTYPE)
+    _add(tar, 'd/small', data=b'replaced', mode=0o640)
+    _add(tar, 'ro', tarfile.DIRTYPE, mode=0o555)
+    _add(tar, 'ro/file', data=b'in a read-only directory')
+
+def _snapshot(root):
+    result = {}
+    for dirpath, dirnames, filenames in os.walk(root):
+        for name in dirnames + filenames:
+            path = os.path.join(dirpath, name)
+            st = os.lstat(path)
+            entry = [stat.S_IFMT(st.st_mode), stat.S_IMODE(st.st_mode),
+                     st.st_nlink]
+            if name in ('sub', 'deep'):
+                # Implicit parents: their mode and mtime are not in the
+                # archive, and extract_tar keeps them private
+                entry = entry[:1]
+            elif stat.S_ISREG(st.st_mode):
+                with open(path, 'rb') as f:
+                    entry += [f.read(), st.st_mtime]
+            elif stat.S_ISLNK(st.st_mode):
+                entry.append(os.readlink(path))
+            elif stat.S_ISDIR(st.st_mode):
+                entry.append(st.st_mtime)
+            result[os.path.relpath(path, root)] = entry
+    return result
+
+class ExtractTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.dir.cleanup)
+        # Read-only directories would stop the cleanup
+        self.addCleanup(lambda: [os.chmod(p, 0o700) for p, _, _ in
+                                 os.walk(self.dir.name)])
+
+    def _dest(self, name):
+        path = os.path.join(self.dir.name, name)
+        os.mkdir(path)
+        return path
+
+    def test_matches_serial_extraction(self):
+        archive = _archive(_sample)
+        serial = self._dest('serial')
+        with tarfile.open(fileobj=archive) as tar:
+            tar.extractall(serial)
+
+        archive.seek(0)
+        parallel = self._dest('parallel')
+        extract_tar(archive, parallel, threads=4)
+        self.assertEqual(_snapshot(parallel), _snapshot(serial))
+
+    def test_not_a_tar(self):
+        with self.assertRaises(tarfile.ReadError):
+            extract_tar(io.BytesIO(b''), self._dest('out'))
+
+    def _assert_refused(self, build):
+        dest = self._dest('out')
+        with self.assertRaises(tarfile.ExtractError):
+            extract_tar(_archive(build), dest)
+        self.assertEqual(os.listdir(self.dir.name), ['out'])
+
+    def test_refuses_escaping_names(self):
+        self._assert_refused(lambda tar: _add(tar, '../evil', data=b'x'))
+        os.rmdir(os.path.join(self.dir.name, 'out'))
+        self._assert_refused(lambda tar: _add(tar, '/tmp/evil', data=b'x'))
+
+    def test_refuses_escaping_symlinks(self):
+        def build(tar):
+            _add(tar, 'up', tarfile.SYMTYPE, linkname='..')
+            _add(tar, 'up/evil', data=b'x')
+        self._assert_refused(build)
+
+    def test_refuses_symlink_chains(self):
+        # Each link stays inside when made, but together they lead out
+        def build(tar):
+            _add(tar, 'a', tarfile.SYMTYPE, linkname='b/..')
+            _add(tar, 'b', tarfile.SYMTYPE, linkname='.')
+            _add(tar, 'a/evil', data=b'x')
+        self._assert_refused(build)
+
+    def test_does_not_write_through_symlinks(self):
+        # f only leads outside once d and e exist
+        dest = self._dest('out')
+        def build(tar):
+            _add(tar, 'f', tarfile.SYMTYPE, linkname='d/escaped')
+            _add(tar, 'd', tarfile.SYMTYPE, linkname='e/..')
+            _add(tar, 'e', tarfile.SYMTYPE, linkname='.')
+            _add(tar, 'f', data=b'x')
+        extract_tar(_archive(build), dest)
+        self.assertEqual(os.listdir(self.dir.name), ['out'])
+        self.assertTrue(stat.S_ISREG(os.lstat(os.path.join(dest, 'f'))
+                                     .st_mode))
+
+if __name__ == '__main__':
+    unittest.main()
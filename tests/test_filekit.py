@@ -0,0 +1,152 @@
+import os, tempfile, unittest
+
+from lfx import filekit
+from lfx.filekit import (AtomicReplacement, SyncBatch, TemporaryFileContext,
+                         remove_stale_links)
+from lfx.mozilla import FirefoxVersion
+from lfx.versionfile import VersionFile
+
+CRASHED = 17
+OLD = b'old content\n'
+NEW = b'new content\n' * 100000
+
+# Every step a durable replacement goes through, in order, and whether the
+# target holds the new content once it has been reached
+POINTS = [('written', False), ('synced', False), ('linked', False),
+          ('renamed', True), ('dirs-synced', True)]
+
+def _supports_tmpfile(directory):
+    try:
+        os.close(os.open(directory, os.O_TMPFILE | os.O_WRONLY, 0o600))
+    except (AttributeError, OSError):
+        return False
+    return True
+
+class CrashTest(unittest.TestCase):
+    '''\
+Forks a writer that dies with os._exit at each crash point of a durable
+replacement, and checks that the target is then entirely old or entirely
+new and that nothing is left next to it once stale links are removed.
+'''
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.dir.cleanup)
+        self.target = os.path.join(self.dir.name, 'target')
+        # Named temporary files live apart, as the launcher's do
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.temp_dir.cleanup)
+        self.tctx = TemporaryFileContext(dir=self.temp_dir.name)
+
+    def _crash_at(self, point, anonymous):
+        with open(self.target, 'wb') as f:
+            f.write(OLD)
+
+        pid = os.fork()
+        if not pid:
+            try:
+                if not anonymous:
+                    del os.O_TMPFILE
+                def hook(name):
+                    if name == point:
+                        os._exit(CRASHED)
+                filekit.CRASH_HOOK = hook
+                with SyncBatch() as batch:
+                    with AtomicReplacement(self.target, self.tctx,
+                                           filekit.DURABILITY_FULL,
+                                           batch) as rep:
+                        rep.write(NEW)
+                        rep.ready = True
+            finally:
+                os._exit(0)
+        return os.waitstatus_to_exitcode(os.waitpid(pid, 0)[1])
+
+    def _check(self, anonymous):
+        for point, replaced in POINTS:
+            with self.subTest(point=point):
+                status = self._crash_at(point, anonymous)
+                if point == 'linked' and not anonymous:
+                    # Named files are never linked, so the write completes
+                    self.assertEqual(status, 0)
+                    replaced = True
+                else:
+                    self.assertEqual(status, CRASHED)
+
+                with open(self.target, 'rb') as f:
+                    self.assertEqual(f.read(), NEW if replaced else OLD)
+
+                remove_stale_links(self.dir.name)
+                self.assertEqual(os.listdir(self.dir.name), ['target'])
+
+    def test_anonymous(self):
+        if not _supports_tmpfile(self.dir.name):
+            self.skipTest('O_TMPFILE not supported')
+        self._check(True)
+
+    def test_named(self):
+        self._check(False)
+
+    def test_stale_links_only(self):
+        names = ['target', 'target.0123456789ab.tmp', 'other.tmp',
+                 'other.0123456789ab.tmp']
+        for name in names:
+            open(os.path.join(self.dir.name, name), 'w').close()
+        remove_stale_links(self.dir.name, 'target.')
+        self.assertEqual(sorted(os.listdir(self.dir.name)),
+                         sorted(set(names) - {'target.0123456789ab.tmp'}))
+
+# Longer than what replaces it, so a torn rewrite leaves old bytes behind
+OLD_VERSION = b'121.0 1700000500.123456789 some-long-tier-name\n'
+LOCK_POINTS = ['lock-written', 'lock-truncated', 'lock-synced']
+
+class VersionFileCrashTest(unittest.TestCase):
+    '''\
+The same for the version file, which LockFile rewrites in place: after a
+crash at any point it must still read as the old or the new version.
+'''
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.dir.cleanup)
+        self.path = os.path.join(self.dir.name, 'firefox-version')
+
+    def _write(self, data):
+        with open(self.path, 'wb') as f:
+            f.write(data)
+
+    def _stored(self):
+        with VersionFile(self.path, FirefoxVersion, 0) as vers:
+            vers.can_skip_updates() # Must not raise
+            return vers.stored
+
+    def test_crash_points(self):
+        for point in LOCK_POINTS:
+            with self.subTest(point=point):
+                self._write(OLD_VERSION)
+                pid = os.fork()
+                if not pid:
+                    try:
+                        def hook(name):
+                            if name == point:
+                                os._exit(CRASHED)
+                        filekit.CRASH_HOOK = hook
+                        with VersionFile(self.path, FirefoxVersion,
+                                         0) as vers:
+                            vers.can_skip_updates()
+                            vers.register_update(FirefoxVersion('122.0'))
+                    finally:
+                        os._exit(0)
+                status = os.waitstatus_to_exitcode(os.waitpid(pid, 0)[1])
+                self.assertEqual(status, CRASHED)
+                self.assertEqual(self._stored()[0], '122.0')
+
+    def test_torn_file(self):
+        self._write(b'121.0 1700000500.12\n4567\n')
+        self.assertEqual(self._stored(), ['121.0', '1700000500.12'])
+
+    def test_mangled_file(self):
+        for data in [b'121.0 17000\xff00500.12\n', b'garbage', b'']:
+            with self.subTest(data=data):
+                self._write(data)
+                self.assertIsNone(self._stored())
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,81 @@
+import io, os, unittest
+from unittest import mock
+
+from lfx import _lzma, lzma
+from lfx.lzma import (FilterParams, LZMACompressor, LZMADecompressor,
+                      LEGACY_PARAMS, read_filter_header, tune_filter)
+
+def setUpModule():
+    try:
+        _lzma._load()
+    except OSError:
+        raise unittest.SkipTest('liblzma not available')
+
+MiB = 1 << 20
+GiB = 1 << 30
+
+class TuneFilterTest(unittest.TestCase):
+    def setUp(self):
+        # Results must not depend on the memory free on this machine
+        patcher = mock.patch.object(lzma, 'available_memory',
+                                    return_value=None)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_dictionary_grows_with_input(self):
+        last = None
+        for size in [0, 1, MiB, 10 * MiB, 100 * MiB, 200 * MiB, GiB,
+                     4 * GiB]:
+            with self.subTest(size=size):
+                params = tune_filter(size, GiB)
+                if last is not None:
+                    self.assertGreaterEqual(params.dict_size,
+                                            last.dict_size)
+                self.assertLessEqual(params.encoder_memusage(), GiB)
+                last = params
+
+    def test_large_profiles_keep_the_legacy_dictionary(self):
+        for size in [100 * MiB, 200 * MiB, GiB, 4 * GiB]:
+            with self.subTest(size=size):
+                self.assertEqual(tune_filter(size, GiB).dict_size,
+                                 LEGACY_PARAMS.dict_size)
+
+    def test_covers_small_inputs(self):
+        self.assertGreaterEqual(tune_filter(10 * MiB, GiB).dict_size,
+                                10 * MiB)
+
+    def test_tiny_budget(self):
+        self.assertEqual(tune_filter(GiB, 1).dict_size, MiB)
+
+class FilterHeaderTest(unittest.TestCase):
+    def test_round_trip(self):
+        params = FilterParams(3, _lzma.MF_BT4, 24 * MiB)
+        f = io.BytesIO(params.header() + b'payload')
+        read = read_filter_header(f)
+        self.assertEqual((read.preset, read.mf, read.dict_size),
+                         (3, _lzma.MF_BT4, 24 * MiB))
+        self.assertEqual(f.read(), b'payload')
+
+    def test_headerless(self):
+        for data in [b'', b'abc', b'\x00' * 64]:
+            f = io.BytesIO(data)
+            self.assertIs(read_filter_header(f), LEGACY_PARAMS)
+            self.assertEqual(f.read(), data)
+
+    def test_decoder_memusage(self):
+        params = FilterParams(6, _lzma.MF_HC4, 128 * MiB)
+        self.assertGreater(params.decoder_memusage(), 128 * MiB)
+
+    def test_stream_round_trip(self):
+        params = FilterParams(1, _lzma.MF_HC4, MiB)
+        data = os.urandom(1000) * 50
+        comp = LZMACompressor(filter=params.filter())
+        out = params.header() + comp.compress(data) + comp.sync()
+
+        f = io.BytesIO(out)
+        read = read_filter_header(f)
+        dec = LZMADecompressor(filter=read.filter())
+        self.assertEqual(dec.decompress(f.read()), data)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,88 @@
+import io, os, tarfile, tempfile, unittest
+
+from lfx.snapshotrules import (Rule, SnapshotRules, DEFAULT_RULES, INCLUDE,
+                               EXCLUDE)
+
+PROFILE = '.mozilla/firefox/abc.default/'
+
+class MatchTest(unittest.TestCase):
+    def setUp(self):
+        self.rules = SnapshotRules(DEFAULT_RULES)
+
+    def test_default_rules_match_profile_directories(self):
+        for path in ('cache2', 'cache2/entries/0123', 'startupCache',
+                     'datareporting/archived/2024-01/ping.jsonlz4',
+                     'storage/temporary/x'):
+            with self.subTest(path=path):
+                self.assertIsNotNone(self.rules.match(PROFILE + path))
+        self.assertIsNotNone(
+            self.rules.match('.mozilla/firefox/Crash Reports/events'))
+
+    def test_star_stays_within_a_component(self):
+        for path in ('storage/default/https+++example.com/idb/crashes',
+                     'storage/default/https+++example.com/idb/crashes/'
+                     'data.sqlite',
+                     'extensions/foo/thumbnails/icon.png',
+                     'cache2x', 'places.sqlite'):
+            with self.subTest(path=path):
+                self.assertIsNone(self.rules.match(PROFILE + path))
+
+    def test_globs(self):
+        rules = SnapshotRules([Rule('a/**/deep'), Rule('b/?'),
+                               Rule('c/[0-9]x'), Rule('d/[!x]')])
+        matches = ['a/deep', 'a/1/2/deep', 'a/1/deep/below', 'b/1',
+                   'c/5x', 'd/y']
+        misses = ['a/deeper', 'b/12', 'b/1x', 'c/ax', 'd/x', 'd//']
+        for path in matches:
+            self.assertIsNotNone(rules.match(path), path)
+        for path in misses:
+            self.assertIsNone(rules.match(path), path)
+
+    def test_first_match_wins(self):
+        keep = Rule('p/keep', INCLUDE)
+        rules = SnapshotRules([keep, Rule('p')])
+        self.assertIs(rules.match('p/keep/file'), keep)
+        self.assertEqual(rules.match('p/other').action, EXCLUDE)
+
+    def test_empty(self):
+        self.assertIsNone(SnapshotRules([]).match('anything'))
+
+class WalkTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.dir.cleanup)
+        self.cwd = os.getcwd()
+        os.chdir(self.dir.name)
+        self.addCleanup(os.chdir, self.cwd)
+
+    def _file(self, path, size):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(b'x' * size)
+
+    def test_counts_and_pruning(self):
+        self._file('p/cache/a', 100)
+        self._file('p/cache/sub/b', 50)
+        self._file('p/big/1', 60)
+        self._file('p/big/2', 60)
+        self._file('p/data', 10)
+        rules = SnapshotRules([Rule('p/cache'),
+                               Rule('p/big', INCLUDE, max_bytes=100)])
+        walk = rules.start()
+        with tarfile.open(fileobj=io.BytesIO(), mode='w') as tar:
+            tar.add('p', filter=walk.filter)
+            names = tar.getnames()
+
+        self.assertNotIn('p/cache', names)
+        self.assertEqual(len([n for n in names if n.startswith('p/big/')]),
+                         1)
+        # Excluded directories are only sized once asked for
+        self.assertEqual(walk._skipped, {'p/big': 60})
+        report = walk.report()
+        self.assertEqual(report['p/cache'], [0, 150])
+        self.assertEqual(report['p/big'], [60, 60])
+        self.assertEqual(report[None][0], 10)
+        self.assertEqual(walk.total_skipped(), 210)
+
+if __name__ == '__main__':
+    unittest.main()
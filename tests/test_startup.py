@@ -0,0 +1,51 @@
+import os, sys, json, subprocess, tempfile, unittest
+
+# Seconds importing the launcher may take; about 50 ms when measured, the
+# rest is headroom for slow or busy machines
+IMPORT_BUDGET = 0.3
+
+PROBE = '''\
+import sys, time, json
+started = time.perf_counter()
+import lfx.launchfirefox
+elapsed = time.perf_counter() - started
+import lfx._lzma
+print(json.dumps({'elapsed': elapsed,
+                  'modules': [m for m in ('ssl', 'http.client')
+                              if m in sys.modules],
+                  'liblzma_loaded': lfx._lzma._lib is not None}))
+'''
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+class StartupTest(unittest.TestCase):
+    '''\
+Importing the launcher must stay cheap and free of side effects; the
+import runs in a fresh interpreter with an empty HOME.
+'''
+    @classmethod
+    def setUpClass(cls):
+        cls.home = tempfile.TemporaryDirectory()
+        env = dict(os.environ, HOME=cls.home.name)
+        output = subprocess.check_output([sys.executable, '-c', PROBE],
+                                         cwd=ROOT, env=env)
+        cls.result = json.loads(output.decode('utf-8'))
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.home.cleanup()
+
+    def test_import_budget(self):
+        self.assertLess(self.result['elapsed'], IMPORT_BUDGET)
+
+    def test_no_main_directory(self):
+        self.assertEqual(os.listdir(self.home.name), [])
+
+    def test_no_network_modules(self):
+        self.assertEqual(self.result['modules'], [])
+
+    def test_liblzma_not_loaded(self):
+        self.assertFalse(self.result['liblzma_loaded'])
+
+if __name__ == '__main__':
+    unittest.main()
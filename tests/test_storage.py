@@ -0,0 +1,229 @@
+import os, re, hashlib, tempfile, threading, unittest
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from unittest import mock
+
+from lfx import storage
+from lfx.storage import (ConflictError, DirectoryStore, HTTPStore,
+                         ProfileSync, MANIFEST_KEY)
+
+PART_RE = re.compile('^profile.([0-9]+).tar.lzD$')
+CHUNK_SIZE = 1000
+
+class _Handler(BaseHTTPRequestHandler):
+    '''\
+A stand-in object store: GET, PUT and DELETE on a dict, with ETags and
+If-Match / If-None-Match on PUT.
+'''
+    protocol_version = 'HTTP/1.1'
+    # Otherwise small replies wait out delayed ACKs on keep-alive
+    disable_nagle_algorithm = True
+
+    def log_message(self, *args):
+        pass
+
+    def _reply(self, status, body=b'', etag=None):
+        self.send_response(status)
+        if etag is not None:
+            self.send_header('ETag', etag)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        data = self.server.objects.get(self.path)
+        if data is None:
+            self._reply(404)
+        else:
+            self._reply(200, data, _etag(data))
+
+    def do_PUT(self):
+        data = self.rfile.read(int(self.headers['Content-Length']))
+        with self.server.lock:
+            current = self.server.objects.get(self.path)
+            match = self.headers.get('If-Match')
+            if ((match is not None and (current is None or
+                                        match != _etag(current))) or
+                    (self.headers.get('If-None-Match') == '*' and
+                     current is not None)):
+                self._reply(412)
+                return
+            self.server.objects[self.path] = data
+        self._reply(201, etag=_etag(data))
+
+    def do_DELETE(self):
+        with self.server.lock:
+            found = self.server.objects.pop(self.path, None) is not None
+        self._reply(204 if found else 404)
+
+def _etag(data):
+    return '"{}"'.format(hashlib.sha256(data).hexdigest())
+
+def _write(directory, n, data):
+    with open(os.path.join(directory, 'profile.{}.tar.lzD'.format(n)),
+              'wb') as f:
+        f.write(data)
+
+def _chain(directory):
+    result = {}
+    for name in os.listdir(directory):
+        if PART_RE.match(name):
+            with open(os.path.join(directory, name), 'rb') as f:
+                result[name] = f.read()
+    return result
+
+class _SyncTests:
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.dir.cleanup)
+        self.store = self.make_store()
+        self.hosts = []
+        for name in ('a', 'b'):
+            path = os.path.join(self.dir.name, name)
+            os.mkdir(path)
+            self.hosts.append(path)
+
+    def sync(self, host):
+        sync = ProfileSync(self.store, host, PART_RE, threading.Lock(),
+                           chunk_size=CHUNK_SIZE, threads=2)
+        self.addCleanup(sync.close)
+        return sync
+
+    def _start(self):
+        a, b = self.hosts
+        _write(a, 0, os.urandom(3 * CHUNK_SIZE + 10))
+        _write(a, 1, os.urandom(CHUNK_SIZE // 2))
+        self.sync(a).push()
+        self.sync(b).pull()
+        return a, b
+
+    def test_round_trip(self):
+        a, b = self._start()
+        self.assertEqual(_chain(b), _chain(a))
+
+        _write(b, 0, os.urandom(2 * CHUNK_SIZE))
+        os.unlink(os.path.join(b, 'profile.1.tar.lzD'))
+        self.sync(b).push()
+        self.sync(a).pull()
+        self.assertEqual(_chain(a), _chain(b))
+        self.assertEqual(list(_chain(a)), ['profile.0.tar.lzD'])
+
+    def test_nothing_to_pull(self):
+        a, = self.hosts[:1]
+        self.sync(a).pull()
+        self.assertEqual(_chain(a), {})
+
+    def test_conflict(self):
+        a, b = self._start()
+        _write(b, 2, b'from b')
+        self.sync(b).push()
+        _write(a, 2, b'from a')
+
+        with self.assertRaises(ConflictError):
+            self.sync(a).pull()
+        with self.assertRaises(ConflictError):
+            self.sync(a).push()
+        self.assertEqual(_chain(a)['profile.2.tar.lzD'], b'from a')
+
+    def test_force_pull(self):
+        a, b = self._start()
+        _write(b, 2, b'from b')
+        self.sync(b).push()
+        _write(a, 2, b'from a')
+        _write(a, 3, b'only on a')
+
+        self.sync(a).pull(force=True)
+        self.assertEqual(_chain(a), _chain(b))
+
+    def test_take_over(self):
+        a, b = self._start()
+        _write(b, 2, b'from b')
+        self.sync(b).push()
+        _write(a, 2, b'from a')
+
+        sync = self.sync(a)
+        sync.take_over()
+        sync.push()
+        self.sync(b).pull(force=True)
+        self.assertEqual(_chain(b)['profile.2.tar.lzD'], b'from a')
+
+    def test_garbage_collection(self):
+        a, b = self._start()
+        old = set(self._chunk_keys(a))
+        _write(a, 0, os.urandom(CHUNK_SIZE))
+        sync = self.sync(a)
+        sync.push()
+        dropped = old - set(self._chunk_keys(a))
+        self.assertTrue(dropped)
+        # Still there for hosts fetching the previous manifest
+        for key in dropped:
+            self.assertTrue(self.exists(key))
+
+        _write(a, 2, b'more')
+        with mock.patch.object(storage, 'GARBAGE_DELAY', 0):
+            sync.push()
+        for key in dropped:
+            self.assertFalse(self.exists(key))
+        self.sync(b).pull()
+        self.assertEqual(_chain(b), _chain(a))
+
+    def test_failed_upload_is_retried(self):
+        a = self.hosts[0]
+        _write(a, 0, os.urandom(CHUNK_SIZE))
+        sync = self.sync(a)
+        with mock.patch.object(self.store, 'put',
+                               side_effect=OSError('down')), \
+             mock.patch('sys.stderr'):
+            sync.schedule()
+            sync.close()
+        self.assertIsInstance(sync.error, OSError)
+        self.assertIsNone(self.store.get_manifest()[0])
+
+        sync = self.sync(a)
+        sync.schedule()
+        sync.close()
+        self.assertIsNone(sync.error)
+        self.sync(self.hosts[1]).pull()
+        self.assertEqual(_chain(self.hosts[1]), _chain(a))
+
+    def _chunk_keys(self, host):
+        return [key for part in self.sync(host).state['parts'].values()
+                for key in part['chunks']]
+
+class DirectoryStoreTest(_SyncTests, unittest.TestCase):
+    def make_store(self):
+        self.root = os.path.join(self.dir.name, 'store')
+        return DirectoryStore(self.root)
+
+    def exists(self, key):
+        return os.path.exists(os.path.join(self.root, key))
+
+class HTTPStoreTest(_SyncTests, unittest.TestCase):
+    def make_store(self):
+        server = ThreadingHTTPServer(('127.0.0.1', 0), _Handler)
+        server.objects, server.lock = {}, threading.Lock()
+        thread = threading.Thread(target=server.serve_forever,
+                                  kwargs={'poll_interval': 0.01},
+                                  daemon=True)
+        thread.start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        self.server = server
+        return HTTPStore('http://127.0.0.1:{}/profiles/'.format(
+            server.server_address[1]))
+
+    def exists(self, key):
+        return '/profiles/' + key in self.server.objects
+
+    def test_manifest_is_conditional(self):
+        data, tag = self.store.get_manifest()
+        self.assertIsNone(data)
+        tag = self.store.put_manifest(b'{}', None)
+        with self.assertRaises(ConflictError):
+            self.store.put_manifest(b'{}', None)
+        with self.assertRaises(ConflictError):
+            self.store.put_manifest(b'{}', '"stale"')
+        self.assertEqual(self.store.get_manifest(), (b'{}', tag))
+        self.assertIn('/profiles/' + MANIFEST_KEY, self.server.objects)
+
+if __name__ == '__main__':
+    unittest.main()